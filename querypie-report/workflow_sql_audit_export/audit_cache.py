@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Local SQLite cache of enrichment metadata shared between runs.
+
+Python 2.7 compatible. Ledger targets are stored per app DB together with the
+row counts and MAX(updated_at) of every table the ledger query joins and are
+reused while all of them are unchanged. blob_meta sizes are stored per snapshot DB and
+snapshot name. Snapshots are never rewritten under the same name, so those
+entries do not expire.
+"""
+import json
+import sqlite3
+
+
+SQLITE_MAX_PARAMS = 500
+
+
+def db_cache_key(config):
+    return u"%s:%s/%s" % (config.host, config.port, config.database)
+
+
+class MetadataCache(object):
+    def __init__(self, path):
+        self.path = path
+        # Worker processes may share one file, so wait for their locks instead of failing.
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.ledger_hits = 0
+        self.ledger_misses = 0
+        self.blob_meta_hits = 0
+        self.blob_meta_misses = 0
+        # ledger_targets held a version of ledger_policy_tables only.
+        self.conn.execute("DROP TABLE IF EXISTS ledger_targets")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ledger_target_rows ("
+            " db_key TEXT PRIMARY KEY, version_json TEXT, rows_json TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blob_meta ("
+            " db_key TEXT, name TEXT, bytes INTEGER, PRIMARY KEY (db_key, name))"
+        )
+        self.conn.commit()
+
+    def get_ledger_rows(self, db_key, version):
+        """Return cached ledger target rows if they were stored with the same version (a JSON-serializable list)."""
+        row = self.conn.execute(
+            "SELECT version_json, rows_json FROM ledger_target_rows WHERE db_key = ?",
+            (db_key,),
+        ).fetchone()
+        if row is None or json.loads(row[0]) != version:
+            self.ledger_misses += 1
+            return None
+        self.ledger_hits += 1
+        return json.loads(row[1])
+
+    def put_ledger_rows(self, db_key, version, rows):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ledger_target_rows (db_key, version_json, rows_json) VALUES (?, ?, ?)",
+            (db_key, json.dumps(version, ensure_ascii=False), json.dumps(rows, ensure_ascii=False)),
+        )
+        self.conn.commit()
+
+    def get_blob_meta(self, db_key, names):
+        """Return {name: bytes} for the cached names. Names not in the result must be read from the DB."""
+        result = {}
+        names = list(names)
+        for start in range(0, len(names), SQLITE_MAX_PARAMS):
+            batch = names[start : start + SQLITE_MAX_PARAMS]
+            rows = self.conn.execute(
+                "SELECT name, bytes FROM blob_meta WHERE db_key = ? AND name IN (%s)" % ",".join(["?"] * len(batch)),
+                [db_key] + batch,
+            )
+            for name, byte_count in rows:
+                result[name] = byte_count
+        self.blob_meta_hits += len(result)
+        self.blob_meta_misses += len(names) - len(result)
+        return result
+
+    def put_blob_meta(self, db_key, blob_meta):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO blob_meta (db_key, name, bytes) VALUES (?, ?, ?)",
+            [(db_key, name, int(byte_count) if byte_count is not None else None) for name, byte_count in blob_meta.items()],
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
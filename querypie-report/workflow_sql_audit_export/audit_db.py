@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Connection reuse shared by the workflow SQL audit export scripts.
+
+Python 2.7 compatible. ConnectionManager hands out one connection per DbConfig
+and purpose and keeps it for the whole run. Each connection reconnects on
+OperationalError/InterfaceError and retries the failed execute(), so one
+dropped network hop does not abort a batch. All statements issued by these
+scripts are reads, so retrying an execute() is safe. Errors raised while
+fetching an already executed result are not retried.
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+
+RECONNECT_ERROR_NAMES = ("OperationalError", "InterfaceError")
+
+
+def is_connection_error(exc):
+    return exc.__class__.__name__ in RECONNECT_ERROR_NAMES
+
+
+def config_key(config):
+    return (config.host, config.port, config.user, config.database, config.charset)
+
+
+class ReconnectingConnection(object):
+    def __init__(self, config, connect_fn, connect_kwargs=None, on_connect=None, retries=2):
+        self.config = config
+        self.connect_fn = connect_fn
+        self.connect_kwargs = connect_kwargs or {}
+        self.on_connect = on_connect
+        self.retries = retries
+        self.reconnect_count = 0
+        self.conn = None
+        self.open()
+
+    @property
+    def driver_module(self):
+        return self.conn.__class__.__module__
+
+    def open(self):
+        self.conn = self.connect_fn(self.config, **self.connect_kwargs)
+        if self.on_connect is not None:
+            self.on_connect(self.conn)
+
+    def reconnect(self, exc, attempt):
+        print(
+            "Reconnecting to %s:%s/%s after %s: %s (attempt %s/%s)"
+            % (self.config.host, self.config.port, self.config.database, exc.__class__.__name__, exc, attempt, self.retries),
+            file=sys.stderr,
+        )
+        self.close()
+        time.sleep(attempt - 1)
+        self.open()
+        self.reconnect_count += 1
+
+    def cursor(self, *args, **kwargs):
+        return ReconnectingCursor(self, args, kwargs)
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+
+
+class ReconnectingCursor(object):
+    def __init__(self, connection, cursor_args, cursor_kwargs):
+        self.connection = connection
+        self.cursor_args = cursor_args
+        self.cursor_kwargs = cursor_kwargs
+        self.cursor = connection.conn.cursor(*cursor_args, **cursor_kwargs)
+
+    def execute(self, sql, params=None):
+        attempt = 0
+        while True:
+            try:
+                return self.cursor.execute(sql, params)
+            except Exception as exc:
+                attempt += 1
+                if not is_connection_error(exc) or attempt > self.connection.retries:
+                    raise
+                self.connection.reconnect(exc, attempt)
+                self.cursor = self.connection.conn.cursor(*self.cursor_args, **self.cursor_kwargs)
+
+    def close(self):
+        try:
+            self.cursor.close()
+        except Exception as exc:
+            if not is_connection_error(exc):
+                raise
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ConnectionManager(object):
+    """Keep one reconnecting connection per DbConfig and purpose for the whole run."""
+
+    def __init__(self, connect_fn, retries=2):
+        self.connect_fn = connect_fn
+        self.retries = retries
+        self.connections = {}
+
+    def get(self, config, purpose="default", on_connect=None, **connect_kwargs):
+        key = (config_key(config), purpose, tuple(sorted(connect_kwargs.items())))
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = ReconnectingConnection(
+                config,
+                self.connect_fn,
+                connect_kwargs=connect_kwargs,
+                on_connect=on_connect,
+                retries=self.retries,
+            )
+            self.connections[key] = connection
+        return connection
+
+    def reconnect_count(self):
+        return sum(connection.reconnect_count for connection in self.connections.values())
+
+    def close_all(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
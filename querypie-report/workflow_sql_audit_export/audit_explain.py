@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+EXPLAIN diagnostics shared by the workflow SQL audit export scripts.
+
+Python 2.7 compatible. explain_plan() runs EXPLAIN FORMAT=JSON on the exact
+SQL and parameters a script would execute. print_explain_report() lists every
+table access of the plan, flags full table scans, full index scans, filesorts
+and temporary tables, and prints the index definitions suggested for the query
+when anything was flagged.
+"""
+from __future__ import print_function
+
+import json
+from collections import OrderedDict
+
+
+SCAN_ACCESS_TYPES = {"ALL": "full table scan", "index": "full index scan"}
+# MySQL reports ordering work as using_filesort / using_temporary_table flags,
+# MariaDB as filesort / temporary_table objects.
+FILESORT_KEYS = ("using_filesort", "filesort")
+TEMPORARY_TABLE_KEYS = ("using_temporary_table", "temporary_table")
+
+
+def explain_plan(cursor, sql, params):
+    """Return the parsed EXPLAIN FORMAT=JSON plan of sql executed with params."""
+    cursor.execute("EXPLAIN FORMAT=JSON " + sql.strip(), params)
+    rows = cursor.fetchall()
+    value = rows[0]
+    if isinstance(value, dict):
+        value = list(value.values())[0]
+    else:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    # Keep the plan order on Python 2 as well.
+    return json.loads(value, object_pairs_hook=OrderedDict)
+
+
+def is_materialized_table(table_name):
+    # <derivedN>, <subqueryN>, <unionM,N>: scanning these is expected.
+    return table_name.startswith("<")
+
+
+def plan_tables_and_findings(plan):
+    """Return (table accesses, findings) of a plan in plan order."""
+    tables = []
+    findings = []
+    stack = [("query_block", plan)]
+    while stack:
+        parent_key, node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(reversed([(parent_key, item) for item in node]))
+            continue
+        if not isinstance(node, dict):
+            continue
+        if parent_key == "table" and "table_name" in node:
+            table_name = node["table_name"]
+            access_type = node.get("access_type")
+            tables.append(node)
+            if access_type in SCAN_ACCESS_TYPES and not is_materialized_table(table_name):
+                findings.append(
+                    "%s on %s (rows examined per scan: %s)"
+                    % (SCAN_ACCESS_TYPES[access_type], table_name, node.get("rows_examined_per_scan", "?")),
+                )
+        for key in FILESORT_KEYS:
+            if node.get(key):
+                findings.append("filesort in %s" % parent_key)
+        for key in TEMPORARY_TABLE_KEYS:
+            if node.get(key):
+                findings.append("temporary table in %s" % parent_key)
+        stack.extend(reversed([(key, value) for key, value in node.items() if isinstance(value, (dict, list))]))
+    return tables, findings
+
+
+def describe_table_access(table):
+    description = "%s: access=%s key=%s rows=%s" % (
+        table["table_name"],
+        table.get("access_type", "?"),
+        table.get("key", "-"),
+        table.get("rows_examined_per_scan", "?"),
+    )
+    if table.get("using_index"):
+        description += " index-only"
+    return description
+
+
+def print_explain_report(label, plan, suggested_indexes):
+    """Print the table accesses and findings of one plan. Returns the number of findings."""
+    tables, findings = plan_tables_and_findings(plan)
+    print(" == EXPLAIN %s ==" % label)
+    for table in tables:
+        print("table %s" % describe_table_access(table))
+    for finding in findings:
+        print("WARNING: %s" % finding)
+    if not findings:
+        print("no full scans or filesorts")
+    elif suggested_indexes:
+        print("suggested indexes:")
+        for definition in suggested_indexes:
+            print("  %s;" % definition)
+    return len(findings)
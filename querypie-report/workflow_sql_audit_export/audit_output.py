@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Output file formats shared by the workflow SQL audit export scripts.
+
+Python 2.7 compatible. A row writer writes the header when it is opened.
+Rows passed to write() or write_rows() are buffered and converted and written
+WRITE_BATCH_ROWS at a time through a large file buffer. Each writer counts the
+rows and the seconds spent writing them.
+
+- csv: the historical output, unchanged.
+- csv.gz: the same CSV bytes, gzip compressed.
+- jsonl: one UTF-8 JSON object per row, keyed by the header. A repeated
+  header name gets a _2, _3, ... suffix, as in parquet.
+- parquet: string columns written with pyarrow, when it is installed.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+
+PY2 = sys.version_info[0] == 2
+TEXT_TYPE = unicode if PY2 else str  # noqa: F821  pylint: disable=undefined-variable
+OUTPUT_FORMATS = ("csv", "csv.gz", "jsonl", "parquet")
+FORMAT_EXTENSIONS = {"csv": ".csv", "csv.gz": ".csv.gz", "jsonl": ".jsonl", "parquet": ".parquet"}
+PARQUET_ROW_GROUP_ROWS = 10000
+WRITE_BATCH_ROWS = 1000
+OUTPUT_BUFFER_BYTES = 1024 * 1024
+
+
+def to_text(value, encoding="utf-8"):
+    if value is None:
+        return u""
+    if PY2 and isinstance(value, unicode):  # noqa: F821  pylint: disable=undefined-variable
+        return value
+    if not PY2 and isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode(encoding, "replace")
+    return unicode(value) if PY2 else str(value)  # noqa: F821  pylint: disable=undefined-variable
+
+
+def text_cell(value):
+    # Most cells are already text, so skip the to_text() call for them.
+    if type(value) is TEXT_TYPE:
+        return value
+    return to_text(value)
+
+
+def is_utf8_sig(encoding):
+    return encoding.lower().replace("_", "-") == "utf-8-sig"
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("--format parquet requires pyarrow. Install it or use csv, csv.gz or jsonl.")
+    return pyarrow, pyarrow.parquet
+
+
+def check_output_format(output_format):
+    """Fail before any DB work when the chosen format cannot be written on this host."""
+    if output_format == "parquet":
+        import_pyarrow()
+
+
+def format_output_path(path, output_format):
+    """Replace a .csv/.csv.gz/.jsonl/.parquet extension of a derived path with the one of output_format."""
+    base = path
+    for extension in sorted(FORMAT_EXTENSIONS.values(), key=len, reverse=True):
+        if base.endswith(extension):
+            base = base[: -len(extension)]
+            break
+    return base + FORMAT_EXTENSIONS[output_format]
+
+
+def unique_column_names(header):
+    """Suffix repeated header names (name_2, name_3, ...) so they can be used as JSON keys and Parquet fields."""
+    seen = {}
+    names = []
+    for name in header:
+        name = to_text(name)
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else u"%s_%s" % (name, seen[name]))
+    return names
+
+
+def make_parent_dir(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    if parent and not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Another worker may have created it in the meantime.
+            if not os.path.isdir(parent):
+                raise
+
+
+def rows_per_second(rows, seconds):
+    return int(rows / seconds) if seconds > 0 else rows
+
+
+class RowWriter(object):
+    """Buffer rows and pass them to write_batch batch_rows at a time. close() flushes and closes fp.
+
+    Each format passes its batch writing method and sets fp to the object to close.
+    """
+
+    def __init__(self, path, write_batch, batch_rows=WRITE_BATCH_ROWS):
+        make_parent_dir(path)
+        self.write_batch = write_batch
+        self.batch_rows = batch_rows
+        self.fp = None
+        self.pending = []
+        self.rows = 0
+        self.write_seconds = 0.0
+
+    def write(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_rows:
+            self.flush()
+
+    def write_rows(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        started = time.time()
+        self.write_batch(self.pending)
+        self.write_seconds += time.time() - started
+        self.rows += len(self.pending)
+        self.pending = []
+
+    def close_file(self):
+        self.fp.close()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.close_file()
+
+
+class CsvRowWriter(RowWriter):
+    """header=None writes no header line."""
+
+    def __init__(self, path, header, encoding, quoting=csv.QUOTE_MINIMAL, compress=False):
+        RowWriter.__init__(self, path, self.write_csv_rows)
+        self.raw = open(path, "wb", OUTPUT_BUFFER_BYTES)
+        binary = gzip.GzipFile(fileobj=self.raw, mode="wb") if compress else self.raw
+        if PY2:
+            self.fp = binary
+            if is_utf8_sig(encoding):
+                self.fp.write(u"\ufeff".encode("utf-8"))
+            cell_encoding = "utf-8" if is_utf8_sig(encoding) else encoding
+            self.convert_cell = lambda value: text_cell(value).encode(cell_encoding)
+        else:
+            self.fp = io.TextIOWrapper(binary, encoding=encoding, newline="")
+            self.convert_cell = text_cell
+        self.writer = csv.writer(self.fp, quoting=quoting)
+        if header is not None:
+            self.write_csv_rows([header])
+
+    def write_csv_rows(self, rows):
+        convert_cell = self.convert_cell
+        self.writer.writerows([[convert_cell(cell) for cell in row] for row in rows])
+
+    def close_file(self):
+        try:
+            self.fp.close()
+        finally:
+            # Closing a GzipFile leaves its fileobj open.
+            if not self.raw.closed:
+                self.raw.close()
+
+
+class JsonLinesRowWriter(RowWriter):
+    def __init__(self, path, header):
+        RowWriter.__init__(self, path, self.write_json_lines)
+        self.header = unique_column_names(header)
+        self.fp = io.open(path, "w", OUTPUT_BUFFER_BYTES, encoding="utf-8")
+
+    def write_json_lines(self, rows):
+        header = self.header
+        lines = []
+        for row in rows:
+            record = OrderedDict(zip(header, [text_cell(cell) for cell in row]))
+            lines.append(to_text(json.dumps(record, ensure_ascii=False)))
+        self.fp.write(u"\n".join(lines) + u"\n")
+
+
+class ParquetRowWriter(RowWriter):
+    """Write string columns, one row group per PARQUET_ROW_GROUP_ROWS rows."""
+
+    def __init__(self, path, header):
+        RowWriter.__init__(self, path, self.write_row_group, batch_rows=PARQUET_ROW_GROUP_ROWS)
+        self.pyarrow, parquet = import_pyarrow()
+        self.schema = self.pyarrow.schema([(name, self.pyarrow.string()) for name in unique_column_names(header)])
+        self.fp = parquet.ParquetWriter(path, self.schema)
+
+    def write_row_group(self, rows):
+        columns = zip(*[[text_cell(cell) for cell in row] for row in rows])
+        arrays = [self.pyarrow.array(list(column), type=self.pyarrow.string()) for column in columns]
+        self.fp.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+
+def open_row_writer(path, header, output_format, encoding, quoting=csv.QUOTE_MINIMAL):
+    """Open a writer for path and write header. encoding and quoting only apply to csv and csv.gz."""
+    if output_format == "csv":
+        return CsvRowWriter(path, header, encoding, quoting=quoting)
+    if output_format == "csv.gz":
+        return CsvRowWriter(path, header, encoding, quoting=quoting, compress=True)
+    if output_format == "jsonl":
+        return JsonLinesRowWriter(path, header)
+    if output_format == "parquet":
+        return ParquetRowWriter(path, header)
+    raise ValueError("Unsupported output format: %s" % output_format)
+
+
+def open_text_input(path, encoding):
+    """Open a CSV input for reading, decompressing it when the name ends with .gz."""
+    if PY2:
+        return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding=encoding, newline="")
+    return open(path, "r", newline="", encoding=encoding)
@@ -10,14 +10,29 @@ querypie_log and reads DML snapshot blobs from the Engine snapshot database.
 from __future__ import print_function
 
 import argparse
+import codecs
 import csv
-import gzip
 import io
 import json
+import multiprocessing
 import os
 import sys
+import time
 import traceback
-from collections import defaultdict
+import zlib
+from collections import OrderedDict, defaultdict, deque
+
+from audit_cache import MetadataCache, db_cache_key
+from audit_db import ConnectionManager
+from audit_explain import explain_plan, print_explain_report
+from audit_output import (
+    OUTPUT_FORMATS,
+    check_output_format,
+    format_output_path,
+    open_row_writer,
+    open_text_input,
+    rows_per_second,
+)
 
 
 PY2 = sys.version_info[0] == 2
@@ -26,6 +41,21 @@ SNAPSHOT_SEPARATOR = u"\n\n--- dml snapshot ---\n\n"
 TOO_LARGE_MESSAGE = u"파일 사이즈가 너무 커서 CSV에 직접 넣기 어렵습니다. (%s)"
 TOO_LARGE_CELL_MESSAGE = u"파일 사이즈가 너무 커서 CSV에 직접 넣기 어렵습니다. (%s)"
 LARGE_FILE_SAVED_MESSAGE = u"파일 사이즈가 너무 커서 별도 파일로 저장했습니다. (%s)"
+BLOB_PREFETCH_MAX_BYTES = 16 * 1024 * 1024
+SNAPSHOT_CACHE_BYTES = 64 * 1024 * 1024
+# Charged per cache entry for the key, the SnapshotValue object and its fields,
+# so entries without content (messages, file paths) also use up the budget.
+SNAPSHOT_CACHE_ENTRY_BYTES = 512
+QUERY_TEXT_MAX_BYTES = 16 * 1024 * 1024
+QUERY_TEXT_TRUNCATED_MESSAGE = u"\n\n--- 쿼리가 너무 커서 앞 %s bytes만 표시했습니다. ---"
+GZIP_INPUT_CHUNK_BYTES = 64 * 1024
+SNAPSHOT_KEY_COLUMN_NAMES = ("id", "_id", "uuid")
+# Adaptive lookup batches also stay below these result sizes per query and
+# change by at most these factors per observed query.
+LOOKUP_MAX_ROWS = 20000
+LOOKUP_MAX_BYTES = 32 * 1024 * 1024
+LOOKUP_MIN_FACTOR = 0.25
+LOOKUP_MAX_FACTOR = 2.0
 
 
 class DbConfig(object):
@@ -70,6 +100,16 @@ class SnapshotValue(object):
         self.message = message
         self.file_path = file_path
         self.inline_threshold = inline_threshold
+        self.parsed_csv = None
+
+    def parsed(self):
+        """Return (header, rows) of the content CSV. Parsed on first use only."""
+        if self.parsed_csv is None:
+            self.parsed_csv = parse_snapshot_csv(self.content)
+        return self.parsed_csv
+
+    def row_count(self):
+        return len(self.parsed()[1])
 
     def render(self):
         if self.content is not None:
@@ -83,6 +123,83 @@ class SnapshotValue(object):
         return u"MISSING uuid=%s" % self.uuid
 
 
+class SnapshotCache(object):
+    """LRU of materialized SnapshotValue objects, bounded by content bytes. max_bytes=None means unbounded."""
+
+    def __init__(self, max_bytes=SNAPSHOT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = snapshot_cache_size(value)
+        if self.max_bytes is not None and (self.max_bytes == 0 or size > self.max_bytes):
+            return
+        if key in self.entries:
+            self.entries.pop(key)
+            self.total_bytes -= self.sizes.pop(key)
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.total_bytes += size
+        while self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(evicted_key)
+            self.evictions += 1
+
+
+class AdaptiveBatchSize(object):
+    """IN list size that follows the observed time, rows and bytes of each lookup query, within [min_size, max_size]."""
+
+    def __init__(self, size, min_size, max_size, target_seconds, max_rows=LOOKUP_MAX_ROWS, max_bytes=LOOKUP_MAX_BYTES):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.size = None
+        self.smallest = None
+        self.largest = None
+        self.set_size(size)
+
+    def __call__(self):
+        return self.size
+
+    def set_size(self, size):
+        self.size = max(self.min_size, min(self.max_size, int(size)))
+        self.smallest = self.size if self.smallest is None else min(self.smallest, self.size)
+        self.largest = self.size if self.largest is None else max(self.largest, self.size)
+
+    def observe(self, count, rows, byte_count, seconds):
+        """Move toward the size at which a query like this one takes target_seconds and stays within max_rows and max_bytes."""
+        if count <= 0:
+            return
+        # Project per looked up value, so a short tail batch is judged fairly.
+        limits = [self.size * LOOKUP_MAX_FACTOR]
+        if seconds > 0:
+            limits.append(count * self.target_seconds / seconds)
+        if rows > 0:
+            limits.append(count * float(self.max_rows) / rows)
+        if byte_count > 0:
+            limits.append(count * float(self.max_bytes) / byte_count)
+        self.set_size(max(self.size * LOOKUP_MIN_FACTOR, min(limits)))
+
+
 def is_text(value):
     if PY2:
         return isinstance(value, unicode)  # noqa: F821  pylint: disable=undefined-variable
@@ -99,21 +216,10 @@ def to_text(value, encoding="utf-8"):
     return unicode(value) if PY2 else str(value)  # noqa: F821  pylint: disable=undefined-variable
 
 
-def csv_cell_encoding(encoding):
-    # utf-8-sig writes a BOM on every encode() call in Python 2. CSV cells must
-    # be encoded as plain UTF-8, with the BOM written once at file start.
-    return "utf-8" if encoding.lower().replace("_", "-") == "utf-8-sig" else encoding
-
-
 def strip_bom(value):
     return to_text(value).lstrip(u"\ufeff")
 
 
-def to_csv_cell(value, encoding):
-    text = to_text(value, encoding)
-    return text.encode(csv_cell_encoding(encoding)) if PY2 else text
-
-
 def env_or_default(name, default=None):
     value = os.environ.get(name)
     return value if value not in (None, "") else default
@@ -123,8 +229,12 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Enrich a Workflow CSV with Query Audit original queries and DML snapshot before/after data.",
     )
-    parser.add_argument("--input", required=True, help="Input Workflow CSV path.")
-    parser.add_argument("--output", required=True, help="Output enriched CSV path.")
+    parser.add_argument("--input", required=True, help="Input Workflow CSV path. A .gz file is read as gzip compressed CSV.")
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output enriched CSV path. With another --format its extension is replaced, e.g. .csv.gz or .jsonl.",
+    )
     parser.add_argument(
         "--workflow-column",
         required=True,
@@ -132,7 +242,21 @@ def parse_args():
     )
     parser.add_argument("--header", dest="header", action="store_true", default=True, help="CSV has a header row. Default.")
     parser.add_argument("--no-header", dest="header", action="store_false", help="CSV has no header row.")
+    add_enrichment_arguments(parser)
+    args = parser.parse_args()
+    validate_enrichment_args(args)
+    return args
+
+
+def add_enrichment_arguments(parser):
+    """Options shared by this script and the export/enrich pipeline."""
     parser.add_argument("--encoding", default="utf-8-sig", help="Input/output CSV encoding. Default: utf-8-sig.")
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Output file format. csv.gz is gzip compressed CSV, jsonl writes one JSON object per row and parquet requires pyarrow. Default: csv.",
+    )
 
     parser.add_argument("--log-db-host", default=env_or_default("QUERYPIE_LOG_DB_HOST", "127.0.0.1"))
     parser.add_argument("--log-db-port", type=int, default=int(env_or_default("QUERYPIE_LOG_DB_PORT", "3306") or "3306"))
@@ -170,6 +294,38 @@ def parse_args():
         help="Directory for large snapshot files when --large-file-mode=file. Default: <output>.snapshots.",
     )
     parser.add_argument("--batch-size", type=int, default=500, help="Workflow UUID batch size for Query Audit lookup. Default: 500.")
+    parser.add_argument(
+        "--lookup-target-seconds",
+        type=float,
+        default=0,
+        help="Adapt workflow batches and Query Audit/blob_meta IN lists so one lookup query takes about this long and returns at most %s rows and %s bytes. --batch-size is the starting size. Use 0 for fixed --batch-size batches. Default: 0."
+        % (LOOKUP_MAX_ROWS, LOOKUP_MAX_BYTES),
+    )
+    parser.add_argument("--min-batch-size", type=int, default=20, help="Smallest adaptive batch size. Default: 20.")
+    parser.add_argument("--max-batch-size", type=int, default=5000, help="Largest adaptive batch size. Default: 5000.")
+    parser.add_argument(
+        "--metadata-cache",
+        default=None,
+        help="SQLite file caching ledger targets and blob_meta sizes between runs. Ledger targets are refreshed when ledger_policy_tables changes. Default: disabled.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Enrich row batches in this many worker processes, each with its own DB connections. Output keeps input row order. Default: 1.",
+    )
+    parser.add_argument(
+        "--query-text-max-bytes",
+        type=int,
+        default=QUERY_TEXT_MAX_BYTES,
+        help="Max decompressed size of one query text. Longer queries are cut with a truncation note. Use 0 for no limit. Default: %s." % QUERY_TEXT_MAX_BYTES,
+    )
+    parser.add_argument(
+        "--snapshot-cache-bytes",
+        type=int,
+        default=SNAPSHOT_CACHE_BYTES,
+        help="Snapshot content kept in memory for reuse across audits and batches. Use 0 to disable. Default: %s." % SNAPSHOT_CACHE_BYTES,
+    )
     parser.add_argument(
         "--include-workflow-uuid",
         action="store_true",
@@ -183,6 +339,16 @@ def parse_args():
         action="store_true",
         help="Fetch and output DML snapshot before/after data. Disabled by default.",
     )
+    parser.add_argument(
+        "--skip-unaudited-workflows",
+        action="store_true",
+        help="Do not write blank rows for workflows without Query Audit rows. Default: write them.",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Print EXPLAIN FORMAT=JSON findings (full scans, filesorts) and suggested indexes for the Query Audit and snapshot queries of the first batch, then exit without writing output.",
+    )
     parser.add_argument(
         "--include-internal-columns",
         action="store_true",
@@ -193,14 +359,24 @@ def parse_args():
         default=env_or_default("QUERYPIE_AUDIT_VENDOR_DIR"),
         help="Directory containing pre-downloaded Python packages, for closed-network hosts. Also configurable with QUERYPIE_AUDIT_VENDOR_DIR.",
     )
-    args = parser.parse_args()
+
+
+def validate_enrichment_args(args):
     if args.batch_size <= 0:
         raise SystemExit("--batch-size must be greater than 0.")
+    if args.lookup_target_seconds < 0:
+        raise SystemExit("--lookup-target-seconds must be 0 or greater.")
+    if args.min_batch_size <= 0 or args.min_batch_size > args.max_batch_size:
+        raise SystemExit("--min-batch-size must be greater than 0 and not greater than --max-batch-size.")
     if args.inline_threshold_bytes <= 0:
         raise SystemExit("--inline-threshold-bytes must be greater than 0.")
-    if args.large_file_mode == "file" and not args.snapshot_output_dir:
-        args.snapshot_output_dir = args.output + ".snapshots"
-    return args
+    if args.workers <= 0:
+        raise SystemExit("--workers must be greater than 0.")
+    if args.query_text_max_bytes < 0:
+        raise SystemExit("--query-text-max-bytes must be 0 or greater.")
+    if args.snapshot_cache_bytes < 0:
+        raise SystemExit("--snapshot-cache-bytes must be 0 or greater.")
+    check_output_format(args.format)
 
 
 def add_vendor_dir(vendor_dir):
@@ -244,12 +420,22 @@ def connect(config):
 
 
 def cursor_for(conn):
-    module = conn.__class__.__module__
+    module = getattr(conn, "driver_module", conn.__class__.__module__)
     if module.startswith("mysql.connector"):
         return conn.cursor(dictionary=True)
     return conn.cursor()
 
 
+def streaming_cursor_for(conn):
+    """Unbuffered dict cursor: rows are read from the server as they are fetched."""
+    module = getattr(conn, "driver_module", conn.__class__.__module__)
+    if module.startswith("mysql.connector"):
+        return conn.cursor(dictionary=True, buffered=False)
+    import pymysql
+
+    return conn.cursor(pymysql.cursors.SSDictCursor)
+
+
 def dict_rows(cursor):
     rows = cursor.fetchall()
     if not rows:
@@ -268,68 +454,47 @@ def chunks(values, size):
         start += size
 
 
-def placeholders(count):
-    return ",".join(["%s"] * count)
-
-
-def read_csv(path, has_header, encoding):
-    if PY2:
-        fp = open(path, "rb")
-        try:
-            reader = csv.reader(fp)
-            all_rows = [[strip_bom(to_text(cell, csv_cell_encoding(encoding))) for cell in row] for row in reader]
-        finally:
-            fp.close()
-    else:
-        with open(path, "r", newline="", encoding=encoding) as fp:
-            all_rows = [[strip_bom(cell) for cell in row] for row in csv.reader(fp)]
-    if has_header and all_rows:
-        return all_rows[0], all_rows[1:]
-    return None, all_rows
+def lookup_batches(values, batch_size, sizer=None):
+    """Fixed batch_size chunks, or chunks of the sizer's current size when adaptive batching is on."""
+    if sizer is None:
+        for batch in chunks(values, batch_size):
+            yield batch
+        return
+    start = 0
+    while start < len(values):
+        size = sizer.size
+        yield values[start : start + size]
+        start += size
 
 
-def write_csv(path, header, rows, encoding):
-    parent = os.path.dirname(os.path.abspath(path))
-    if parent and not os.path.exists(parent):
-        os.makedirs(parent)
+def observe_lookup(sizer, batch, rows, started):
+    byte_count = 0
+    for row in rows:
+        for value in row.values():
+            if is_text(value) or isinstance(value, (bytes, bytearray)):
+                byte_count += len(value)
+    sizer.observe(len(batch), len(rows), byte_count, time.time() - started)
 
-    if PY2:
-        fp = open(path, "wb")
-        try:
-            if encoding.lower().replace("_", "-") == "utf-8-sig":
-                fp.write(u"\ufeff".encode("utf-8"))
-            writer = csv.writer(fp)
-            if header is not None:
-                writer.writerow([to_csv_cell(cell, encoding) for cell in header])
-            for row in rows:
-                writer.writerow([to_csv_cell(cell, encoding) for cell in row])
-        finally:
-            fp.close()
-    else:
-        with open(path, "w", newline="", encoding=encoding) as fp:
-            writer = csv.writer(fp)
-            if header is not None:
-                writer.writerow(header)
-            writer.writerows(rows)
 
+def placeholders(count):
+    return ",".join(["%s"] * count)
 
-def open_csv_writer(path, encoding):
-    parent = os.path.dirname(os.path.abspath(path))
-    if parent and not os.path.exists(parent):
-        os.makedirs(parent)
 
+def iter_csv_rows(fp, encoding):
     if PY2:
-        fp = open(path, "wb")
-        if encoding.lower().replace("_", "-") == "utf-8-sig":
-            fp.write(u"\ufeff".encode("utf-8"))
-        return fp, csv.writer(fp)
-
-    fp = open(path, "w", newline="", encoding=encoding)
-    return fp, csv.writer(fp)
+        for row in csv.reader(fp):
+            yield [strip_bom(to_text(cell, encoding)) for cell in row]
+    else:
+        for row in csv.reader(fp):
+            yield [strip_bom(cell) for cell in row]
 
 
-def write_csv_row(writer, row, encoding):
-    writer.writerow([to_csv_cell(cell, encoding) for cell in row])
+def open_csv_reader(path, has_header, encoding):
+    """Return (fp, header, rows) where rows is a lazy iterator over the data rows. The caller closes fp."""
+    fp = open_text_input(path, encoding)
+    rows = iter_csv_rows(fp, encoding)
+    header = next(rows, None) if has_header else None
+    return fp, header, rows
 
 
 def normalize_uuid(value):
@@ -356,15 +521,6 @@ def normalize_identifier(value):
     return text.lower()
 
 
-def normalize_ledger_key(connection_name, database_name, schema_name, table_name):
-    return (
-        normalize_identifier(connection_name),
-        normalize_identifier(database_name),
-        normalize_identifier(schema_name),
-        normalize_identifier(table_name),
-    )
-
-
 def parse_query_table(value, fallback_database_name):
     original = to_text(value).strip()
     parts = [normalize_identifier(part) for part in original.split(".") if to_text(part).strip()]
@@ -381,7 +537,51 @@ def render_table_name(database_name, schema_name, table_name):
     return u".".join([value for value in (to_text(database_name).strip(), to_text(schema_name).strip(), to_text(table_name).strip()) if value])
 
 
-def read_ledger_targets(conn):
+LEDGER_TARGET_COLUMNS = (
+    "connection_name",
+    "database_name",
+    "schema_name",
+    "table_name",
+    "ledger_table_created_at",
+    "ledger_table_updated_at",
+)
+
+
+def read_ledger_version(conn):
+    """[table, row count, latest update] of every table joined by query_ledger_targets, used to validate cached ledger targets."""
+    sql = " UNION ALL ".join(
+        "SELECT '%s' AS table_name, COUNT(*) AS row_count, MAX(updated_at) AS max_updated_at FROM %s" % (table, table)
+        for table in LEDGER_VERSION_TABLES
+    )
+    cursor = cursor_for(conn)
+    try:
+        cursor.execute(sql)
+        rows = dict((to_text(row.get("table_name")), row) for row in dict_rows(cursor))
+    finally:
+        cursor.close()
+    return [
+        [table, int(rows[table].get("row_count") or 0), to_text(rows[table].get("max_updated_at"))]
+        for table in LEDGER_VERSION_TABLES
+    ]
+
+
+def read_ledger_targets(conn, cache=None, cache_key=None):
+    if cache is not None:
+        version = read_ledger_version(conn)
+        rows = cache.get_ledger_rows(cache_key, version)
+        if rows is None:
+            rows = query_ledger_targets(conn)
+            cache.put_ledger_rows(cache_key, version, rows)
+    else:
+        rows = query_ledger_targets(conn)
+    return LedgerIndex(rows)
+
+
+# Soft deletes and renames in any of these tables change the ledger targets.
+LEDGER_VERSION_TABLES = ("ledger_policy_tables", "policies", "ledger_policies", "workflow_rules", "cluster_groups")
+
+
+def query_ledger_targets(conn):
     sql = """
         SELECT DISTINCT
             cg.name AS connection_name,
@@ -408,45 +608,84 @@ def read_ledger_targets(conn):
           AND lpt.table_name IS NOT NULL AND lpt.table_name <> ''
         ORDER BY cg.name, lp.database_name, lpt.schema_name, lpt.table_name
     """
-    exact_keys = set()
-    by_connection_database_table = defaultdict(list)
-    display_by_key = {}
-    created_at_by_key = {}
-    updated_at_by_key = {}
     cursor = cursor_for(conn)
     try:
         cursor.execute(sql)
-        for row in dict_rows(cursor):
-            key = normalize_ledger_key(row.get("connection_name"), row.get("database_name"), row.get("schema_name"), row.get("table_name"))
-            exact_keys.add(key)
-            by_connection_database_table[(key[0], key[1], key[3])].append(key)
+        return [dict((column, to_text(row.get(column))) for column in LEDGER_TARGET_COLUMNS) for row in dict_rows(cursor)]
+    finally:
+        cursor.close()
+
+
+class LedgerIndex(object):
+    """Ledger table targets keyed by normalized (connection, database, schema, table).
+
+    Match results are built once, both for exact keys and for lookups without
+    a schema, which match every schema of the same connection/database/table.
+    """
+
+    __slots__ = ("exact_results", "wildcard_results", "normalized")
+
+    NO_MATCH = (False, u"", u"", u"")
+
+    def __init__(self, rows):
+        self.normalized = {}
+        self.exact_results = {}
+        self.wildcard_results = {}
+        display_by_key = {}
+        created_at_by_key = {}
+        updated_at_by_key = {}
+        by_connection_database_table = defaultdict(list)
+        for row in rows:
+            key = self.normalize_key(row.get("connection_name"), row.get("database_name"), row.get("schema_name"), row.get("table_name"))
+            if key not in display_by_key:
+                by_connection_database_table[(key[0], key[1], key[3])].append(key)
             display_by_key[key] = render_table_name(row.get("database_name"), row.get("schema_name"), row.get("table_name"))
             created_at_by_key[key] = to_text(row.get("ledger_table_created_at"))
             updated_at_by_key[key] = to_text(row.get("ledger_table_updated_at"))
-    finally:
-        cursor.close()
-    return exact_keys, by_connection_database_table, display_by_key, created_at_by_key, updated_at_by_key
-
-
-def find_ledger_match(connection_name, database_name, schema_name, table_name, ledger_data):
-    exact_keys, by_connection_database_table, display_by_key, created_at_by_key, updated_at_by_key = ledger_data
-    key = normalize_ledger_key(connection_name, database_name, schema_name, table_name)
-    candidates = [key] if key in exact_keys else by_connection_database_table.get((key[0], key[1], key[3]), [])
-    if not candidates:
-        return False, u"", u"", u""
-    if key[2]:
-        candidates = [candidate for candidate in candidates if candidate[2] == key[2]]
-        if not candidates:
-            return False, u"", u"", u""
-    return (
-        True,
-        u", ".join([display_by_key.get(candidate, u"") for candidate in candidates]),
-        u", ".join([created_at_by_key.get(candidate, u"") for candidate in candidates]),
-        u", ".join([updated_at_by_key.get(candidate, u"") for candidate in candidates]),
-    )
 
+        def match_result(keys):
+            return (
+                True,
+                u", ".join([display_by_key[key] for key in keys]),
+                u", ".join([created_at_by_key[key] for key in keys]),
+                u", ".join([updated_at_by_key[key] for key in keys]),
+            )
 
-def resolve_workflow_column(rows, header, column):
+        for key in display_by_key:
+            self.exact_results[key] = match_result([key])
+        for wildcard_key, keys in by_connection_database_table.items():
+            self.wildcard_results[wildcard_key] = match_result(keys)
+
+    def __len__(self):
+        return len(self.exact_results)
+
+    def normalize(self, value):
+        normalized = self.normalized.get(value)
+        if normalized is None:
+            normalized = normalize_identifier(value)
+            self.normalized[value] = normalized
+        return normalized
+
+    def normalize_key(self, connection_name, database_name, schema_name, table_name):
+        return (
+            self.normalize(connection_name),
+            self.normalize(database_name),
+            self.normalize(schema_name),
+            self.normalize(table_name),
+        )
+
+    def match(self, connection_name, database_name, schema_name, table_name):
+        """Return (is_ledger, matched tables, created_at values, updated_at values)."""
+        key = self.normalize_key(connection_name, database_name, schema_name, table_name)
+        result = self.exact_results.get(key)
+        if result is not None:
+            return result
+        if key[2]:
+            return self.NO_MATCH
+        return self.wildcard_results.get((key[0], key[1], key[3]), self.NO_MATCH)
+
+
+def resolve_workflow_column(header, column):
     if column.isdigit():
         index = int(column) - 1
     elif header is not None:
@@ -457,36 +696,47 @@ def resolve_workflow_column(rows, header, column):
     else:
         raise SystemExit("--workflow-column must be a 1-based index when --no-header is used.")
 
-    width = len(header) if header is not None else (len(rows[0]) if rows else 0)
-    if index < 0 or index >= width:
+    if index < 0 or (header is not None and index >= len(header)):
         raise SystemExit("Workflow column index out of range: %s" % column)
     return index
 
 
-def read_query_audits(conn, workflow_uuids, batch_size):
+QUERY_AUDITS_SQL = """
+    SELECT
+        l.query_request_uuid AS workflow_uuid,
+        l.uuid AS query_audit_uuid,
+        l.query_request_sub_query_index AS sub_query_index,
+        DATE_FORMAT(DATE_ADD(l.executed_at, INTERVAL 9 HOUR), '%%Y-%%m-%%d %%H:%%i:%%s') AS executed_at,
+        l.processed_record_count AS processed_record_count,
+        l.query_text AS short_query_text,
+        d.full_query_text AS compressed_full_query_text,
+        d.target_object_names AS target_object_names_csv,
+        d.data_changes AS data_changes_json
+    FROM l_query_execution_logs l
+    LEFT JOIN l_query_execution_log_details d ON d.id = l.id
+    WHERE l.query_request_uuid IN ({ids})
+      AND l.hidden = 0
+    ORDER BY l.query_request_uuid, l.query_request_sub_query_index, l.executed_at, l.id
+"""
+# The selected query text columns always come from the row, so the best plan is
+# one index range in ORDER BY order with the hidden filter applied in the index.
+QUERY_AUDIT_INDEX_SUGGESTIONS = (
+    "CREATE INDEX ix_qel_audit_export ON l_query_execution_logs"
+    " (query_request_uuid, hidden, query_request_sub_query_index, executed_at, id)",
+)
+
+
+def read_query_audits(conn, workflow_uuids, batch_size, sizer=None):
     result = defaultdict(list)
-    sql_template = """
-        SELECT
-            l.query_request_uuid AS workflow_uuid,
-            l.uuid AS query_audit_uuid,
-            l.query_request_sub_query_index AS sub_query_index,
-            DATE_FORMAT(DATE_ADD(l.executed_at, INTERVAL 9 HOUR), '%%Y-%%m-%%d %%H:%%i:%%s') AS executed_at,
-            l.processed_record_count AS processed_record_count,
-            l.query_text AS short_query_text,
-            d.full_query_text AS compressed_full_query_text,
-            d.target_object_names AS target_object_names_csv,
-            d.data_changes AS data_changes_json
-        FROM l_query_execution_logs l
-        LEFT JOIN l_query_execution_log_details d ON d.id = l.id
-        WHERE l.query_request_uuid IN ({ids})
-          AND l.hidden = 0
-        ORDER BY l.query_request_uuid, l.query_request_sub_query_index, l.executed_at, l.id
-    """
     cursor = cursor_for(conn)
     try:
-        for batch in chunks(workflow_uuids, batch_size):
-            cursor.execute(sql_template.format(ids=placeholders(len(batch))), batch)
-            for row in dict_rows(cursor):
+        for batch in lookup_batches(workflow_uuids, batch_size, sizer):
+            started = time.time()
+            cursor.execute(QUERY_AUDITS_SQL.format(ids=placeholders(len(batch))), batch)
+            rows = dict_rows(cursor)
+            if sizer is not None:
+                observe_lookup(sizer, batch, rows, started)
+            for row in rows:
                 audit = QueryAuditRow(
                     workflow_uuid=to_text(row.get("workflow_uuid")),
                     query_audit_uuid=to_text(row.get("query_audit_uuid")),
@@ -505,6 +755,9 @@ def read_query_audits(conn, workflow_uuids, batch_size):
 
 
 def row_batches(rows, workflow_col_index, batch_size):
+    """batch_size is a number of workflow UUIDs, or a callable returning it for each new batch."""
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    limit = next_size()
     batch = []
     workflow_uuids = set()
     for row in rows:
@@ -512,22 +765,77 @@ def row_batches(rows, workflow_col_index, batch_size):
         workflow_uuid = normalize_uuid(row[workflow_col_index]) if len(row) > workflow_col_index else u""
         if workflow_uuid:
             workflow_uuids.add(workflow_uuid)
-        if len(workflow_uuids) >= batch_size:
+        if len(workflow_uuids) >= limit:
             yield batch
             batch = []
             workflow_uuids = set()
+            limit = next_size()
     if batch:
         yield batch
 
 
-def decode_query_text(compressed_full_query_text, short_query_text):
+def iter_input_chunks(raw, size):
+    """Yield size byte slices of raw without copying it: buffer objects on Python 2, memoryview slices on 3."""
+    if PY2:
+        for offset in range(0, len(raw), size):
+            yield buffer(raw, offset, size)  # noqa: F821  pylint: disable=undefined-variable
+        return
+    view = memoryview(raw)
+    for offset in range(0, len(raw), size):
+        yield view[offset : offset + size]
+
+
+def inflate_gzip(raw, max_bytes):
+    """Inflate gzip bytes incrementally. Returns (data, truncated); data never exceeds max_bytes."""
+    parts = []
+    total = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in iter_input_chunks(raw, GZIP_INPUT_CHUNK_BYTES):
+        if decompressor is None:
+            # Between members GzipFile skips NUL padding; only such chunks are copied.
+            chunk = bytes(chunk).lstrip(b"\x00")
+            if not chunk:
+                continue
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Only the unconsumed rest of this chunk is fed back, never the rest of raw.
+        while chunk:
+            data = decompressor.decompress(chunk, max_bytes - total + 1 if max_bytes else 0)
+            parts.append(data)
+            total += len(data)
+            if max_bytes and total > max_bytes:
+                return b"".join(parts)[:max_bytes], True
+            chunk = decompressor.unconsumed_tail
+            if decompressor.unused_data:
+                # Concatenated gzip members, as GzipFile reads them.
+                chunk = decompressor.unused_data.lstrip(b"\x00")
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if chunk else None
+    if decompressor is not None:
+        parts.append(decompressor.flush())
+    data = b"".join(parts)
+    if max_bytes and len(data) > max_bytes:
+        return data[:max_bytes], True
+    return data, False
+
+
+def decode_capped_utf8(data, truncated, max_bytes):
+    # A cut in the middle of a multi-byte character is dropped, not replaced.
+    text = codecs.getincrementaldecoder("utf-8")("replace").decode(data, final=not truncated)
+    if truncated:
+        text += QUERY_TEXT_TRUNCATED_MESSAGE % max_bytes
+    return text
+
+
+def decode_query_text(compressed_full_query_text, short_query_text, max_bytes=QUERY_TEXT_MAX_BYTES):
+    """Return the full query text, inflated without ever holding more than max_bytes. 0 disables the cap."""
     if compressed_full_query_text:
         raw = bytes(compressed_full_query_text) if not PY2 else compressed_full_query_text
         try:
-            return gzip.GzipFile(fileobj=io.BytesIO(raw)).read().decode("utf-8", "replace")
+            data, truncated = inflate_gzip(raw, max_bytes)
+            return decode_capped_utf8(data, truncated, max_bytes)
         except Exception:
             try:
-                return raw.decode("utf-8", "replace") if not PY2 else raw.decode("utf-8", "replace")
+                truncated = bool(max_bytes) and len(raw) > max_bytes
+                return decode_capped_utf8(raw[:max_bytes] if truncated else raw, truncated, max_bytes)
             except Exception:
                 pass
     return short_query_text or u""
@@ -564,20 +872,36 @@ def collect_snapshot_uuids(audits_by_workflow):
     return snapshot_uuids
 
 
-def read_blob_meta(conn, snapshot_uuids, batch_size):
+BLOB_META_SQL = "SELECT name, bytes FROM blob_meta WHERE name IN ({ids})"
+BLOB_CONTENTS_SQL = "SELECT name, data FROM blobs WHERE name IN ({ids}) ORDER BY name, idx"
+BLOB_META_INDEX_SUGGESTIONS = ("CREATE INDEX ix_blob_meta_audit_export ON blob_meta (name, bytes)",)
+BLOB_CONTENTS_INDEX_SUGGESTIONS = ("CREATE INDEX ix_blobs_audit_export ON blobs (name, idx)",)
+
+
+def read_blob_meta(conn, snapshot_uuids, batch_size, cache=None, cache_key=None, sizer=None):
     if not snapshot_uuids:
         return {}
     result = {}
     names = sorted(snapshot_uuids)
-    sql_template = "SELECT name, bytes FROM blob_meta WHERE name IN ({ids})"
+    if cache is not None:
+        result = cache.get_blob_meta(cache_key, names)
+        names = [name for name in names if name not in result]
+    fetched = {}
     cursor = cursor_for(conn)
     try:
-        for batch in chunks(names, batch_size):
-            cursor.execute(sql_template.format(ids=placeholders(len(batch))), batch)
-            for row in dict_rows(cursor):
-                result[to_text(row.get("name"))] = row.get("bytes")
+        for batch in lookup_batches(names, batch_size, sizer):
+            started = time.time()
+            cursor.execute(BLOB_META_SQL.format(ids=placeholders(len(batch))), batch)
+            rows = dict_rows(cursor)
+            if sizer is not None:
+                observe_lookup(sizer, batch, rows, started)
+            for row in rows:
+                fetched[to_text(row.get("name"))] = row.get("bytes")
     finally:
         cursor.close()
+    if cache is not None and fetched:
+        cache.put_blob_meta(cache_key, fetched)
+    result.update(fetched)
     return result
 
 
@@ -597,7 +921,81 @@ def read_blob_content(conn, name):
         cursor.close()
 
 
-def materialize_snapshot(conn, name, blob_meta, threshold, large_file_mode, output_dir):
+def stream_blob_to_file(conn, name, path):
+    """Write the blobs.data chunks of name to path one chunk at a time. Returns False when there is no data."""
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    # Written under a per-process name and renamed, so --workers never interleave writes to one file.
+    temp_path = "%s.%s.tmp" % (path, os.getpid())
+    fp = None
+    cursor = streaming_cursor_for(conn)
+    try:
+        cursor.execute("SELECT data FROM blobs WHERE name=%s ORDER BY idx", (name,))
+        while True:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            data = row.get("data") if isinstance(row, dict) else row[0]
+            if data is None:
+                continue
+            if fp is None:
+                fp = io.open(temp_path, "w", encoding="utf-8")
+            fp.write(decoder.decode(bytes(data) if not PY2 else data))
+        if fp is None:
+            return False
+        fp.write(decoder.decode(b"", True))
+        fp.close()
+        fp = None
+        os.rename(temp_path, path)
+        return True
+    finally:
+        if fp is not None:
+            fp.close()
+            os.remove(temp_path)
+        cursor.close()
+
+
+def inline_snapshot_names(blob_meta, threshold):
+    return sorted(name for name, byte_count in blob_meta.items() if byte_count is None or int(byte_count) < threshold)
+
+
+def blob_fetch_batches(names, blob_meta, batch_size, max_bytes):
+    """Group names by count and by the blob_meta byte total so one IN query stays bounded."""
+    batch = []
+    batch_bytes = 0
+    for name in names:
+        byte_count = int(blob_meta.get(name) or 0)
+        if batch and (len(batch) >= batch_size or batch_bytes + byte_count > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(name)
+        batch_bytes += byte_count
+    if batch:
+        yield batch
+
+
+def read_blob_contents(conn, names, blob_meta, batch_size):
+    """Prefetch many snapshot blobs with batched IN queries. Missing blobs map to None."""
+    result = dict((name, None) for name in names)
+    if not names:
+        return result
+    cursor = cursor_for(conn)
+    try:
+        for batch in blob_fetch_batches(names, blob_meta, batch_size, BLOB_PREFETCH_MAX_BYTES):
+            cursor.execute(BLOB_CONTENTS_SQL.format(ids=placeholders(len(batch))), batch)
+            parts_by_name = defaultdict(list)
+            for row in dict_rows(cursor):
+                data = row.get("data")
+                if data is not None:
+                    parts_by_name[to_text(row.get("name"))].append(bytes(data) if not PY2 else data)
+            for name, parts in parts_by_name.items():
+                result[name] = b"".join(parts).decode("utf-8", "replace")
+    finally:
+        cursor.close()
+    return result
+
+
+def materialize_snapshot(conn, name, blob_meta, threshold, large_file_mode, output_dir, blob_contents=None):
     byte_count = blob_meta.get(name)
     if name not in blob_meta:
         return SnapshotValue(uuid=name, message=u"MISSING uuid=%s" % name)
@@ -606,20 +1004,19 @@ def materialize_snapshot(conn, name, blob_meta, threshold, large_file_mode, outp
         if large_file_mode == "file":
             if output_dir is None:
                 raise SystemExit("--snapshot-output-dir is required when --large-file-mode=file")
-            content = read_blob_content(conn, name)
-            if content is None:
-                return SnapshotValue(uuid=name, byte_count=byte_count, message=u"MISSING uuid=%s bytes=%s" % (name, byte_count))
             if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
+                try:
+                    os.makedirs(output_dir)
+                except OSError:
+                    # Another --workers process may have created it first.
+                    if not os.path.isdir(output_dir):
+                        raise
             file_name = name.replace("/", "_")
             if not file_name.lower().endswith(".csv"):
                 file_name += ".csv"
             path = os.path.join(output_dir, file_name)
-            fp = io.open(path, "w", encoding="utf-8")
-            try:
-                fp.write(content)
-            finally:
-                fp.close()
+            if not stream_blob_to_file(conn, name, path):
+                return SnapshotValue(uuid=name, byte_count=byte_count, message=u"MISSING uuid=%s bytes=%s" % (name, byte_count))
             return SnapshotValue(uuid=name, byte_count=byte_count, file_path=path, inline_threshold=threshold)
 
         print("TOO_LARGE_MESSAGE: %s" % (byte_count), file=sys.stderr)
@@ -629,23 +1026,54 @@ def materialize_snapshot(conn, name, blob_meta, threshold, large_file_mode, outp
             message=TOO_LARGE_MESSAGE % (byte_count),
         )
 
-    content = read_blob_content(conn, name)
+    if blob_contents is not None and name in blob_contents:
+        content = blob_contents[name]
+    else:
+        content = read_blob_content(conn, name)
     return SnapshotValue(uuid=name, byte_count=byte_count, content=content)
 
 
-def materialize_snapshot_cached(conn, name, blob_meta, threshold, large_file_mode, output_dir, cache):
+def snapshot_cache_key(name, blob_meta, threshold, large_file_mode, output_dir):
+    # Saved-file values point into output_dir, which the pipeline changes per
+    # output file. Inline and message values are the same for the whole run.
+    byte_count = blob_meta.get(name)
+    if large_file_mode == "file" and byte_count is not None and int(byte_count) >= threshold:
+        return (name, output_dir)
+    return (name, None)
+
+
+def snapshot_cache_size(value):
+    size = SNAPSHOT_CACHE_ENTRY_BYTES + byte_len(value.uuid) + byte_len(value.message) + byte_len(value.file_path)
+    if value.content is None:
+        return size
+    # Counts the content once and its parsed rows, created on first use, once more.
+    if value.byte_count is not None:
+        return size + 2 * int(value.byte_count)
+    return size + 2 * byte_len(value.content)
+
+
+def materialize_snapshot_cached(conn, name, blob_meta, threshold, large_file_mode, output_dir, cache, blob_contents=None, plan=None):
     if not name:
         return None
-    if name not in cache:
-        cache[name] = materialize_snapshot(conn, name, blob_meta, threshold, large_file_mode, output_dir)
-    return cache[name]
+    byte_count = blob_meta.get(name)
+    if plan is not None and name not in plan.content_names and byte_count is not None and int(byte_count) < threshold:
+        # Only rendered into a cell that is already planned as too large.
+        return SnapshotValue(uuid=name, byte_count=byte_count)
+    key = snapshot_cache_key(name, blob_meta, threshold, large_file_mode, output_dir)
+    value = cache.get(key)
+    if value is None:
+        value = materialize_snapshot(conn, name, blob_meta, threshold, large_file_mode, output_dir, blob_contents)
+        cache.put(key, value)
+    return value
 
 
 def byte_len(value):
     return len(to_text(value).encode("utf-8"))
 
 
-def render_snapshot_values(values, threshold):
+def render_snapshot_values(values, threshold, planned_bytes=None):
+    if planned_bytes is not None and planned_bytes >= threshold:
+        return TOO_LARGE_CELL_MESSAGE % planned_bytes
     rendered_values = [value.render() for value in values if value is not None]
     rendered = SNAPSHOT_SEPARATOR.join(rendered_values)
     if rendered and byte_len(rendered) >= threshold:
@@ -653,6 +1081,68 @@ def render_snapshot_values(values, threshold):
     return rendered
 
 
+def planned_render_bytes(name, blob_meta, threshold, large_file_mode):
+    """Byte size SnapshotValue.render() will have for name, from blob_meta alone. None if unknown."""
+    if name not in blob_meta:
+        return byte_len(u"MISSING uuid=%s" % name)
+    byte_count = blob_meta[name]
+    if byte_count is None:
+        return None
+    if int(byte_count) >= threshold:
+        message = LARGE_FILE_SAVED_MESSAGE if large_file_mode == "file" else TOO_LARGE_MESSAGE
+        return byte_len(message % byte_count)
+    return int(byte_count)
+
+
+def planned_cell_bytes(names, blob_meta, threshold, large_file_mode):
+    if not names:
+        return 0
+    total = byte_len(SNAPSHOT_SEPARATOR) * (len(names) - 1)
+    for name in names:
+        size = planned_render_bytes(name, blob_meta, threshold, large_file_mode)
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+class SnapshotCellPlan(object):
+    """Planned before/after cell sizes of one audit and the snapshots whose content is still needed."""
+
+    def __init__(self, before_bytes, after_bytes, content_names):
+        self.before_bytes = before_bytes
+        self.after_bytes = after_bytes
+        self.content_names = content_names
+
+
+def plan_snapshot_cells(audit, blob_meta, threshold, large_file_mode):
+    # Content is needed to render a cell that fits, to diff a before/after
+    # pair, and to count rows when the audit has no processed_record_count.
+    before_names = []
+    after_names = []
+    content_names = set()
+    for change in parse_data_changes(audit.data_changes_json):
+        old_uuid = change.get("oldDataSnapshotUuid")
+        new_uuid = change.get("newDataSnapshotUuid")
+        old_name = old_uuid.strip() if is_text(old_uuid) else u""
+        new_name = new_uuid.strip() if is_text(new_uuid) else u""
+        if old_name:
+            before_names.append(old_name)
+        if new_name:
+            after_names.append(new_name)
+        if old_name and new_name:
+            content_names.update((old_name, new_name))
+    if audit.processed_record_count is None:
+        content_names.update(before_names + after_names)
+    before_bytes = planned_cell_bytes(before_names, blob_meta, threshold, large_file_mode)
+    after_bytes = planned_cell_bytes(after_names, blob_meta, threshold, large_file_mode)
+    if before_bytes is None or before_bytes < threshold:
+        content_names.update(before_names)
+    if after_bytes is None or after_bytes < threshold:
+        content_names.update(after_names)
+    return SnapshotCellPlan(before_bytes, after_bytes, content_names)
+
+
 def render_snapshot_side(snapshot_conn, snapshot_names, blob_meta, threshold, large_file_mode, output_dir):
     rendered = []
     for name in snapshot_names:
@@ -696,29 +1186,76 @@ def try_parse_json(value):
         return None
 
 
-def flatten_json_paths(value, prefix=u""):
-    result = {}
+JSON_MISSING = object()
+
+
+def json_child_path(prefix, key):
+    return u"%s.%s" % (prefix, to_text(key)) if prefix else to_text(key)
+
+
+def json_index_path(prefix, index):
+    return u"%s[%s]" % (prefix, index) if prefix else u"[%s]" % index
+
+
+def json_node_kind(path, value):
+    # An empty list below the root is a leaf rendered as []. An empty dict or
+    # an empty root list has no leaf paths at all.
+    if value is JSON_MISSING:
+        return "missing"
     if isinstance(value, dict):
-        for key in sorted(value.keys()):
-            path = u"%s.%s" % (prefix, to_text(key)) if prefix else to_text(key)
-            result.update(flatten_json_paths(value.get(key), path))
-        return result
-    if isinstance(value, list):
-        for index, item in enumerate(value):
-            path = u"%s[%s]" % (prefix, index) if prefix else u"[%s]" % index
-            result.update(flatten_json_paths(item, path))
-        if not value and prefix:
-            result[prefix] = u"[]"
-        return result
-    result[prefix or u"$"] = json.dumps(value, ensure_ascii=False, sort_keys=True)
-    return result
+        return "dict"
+    if isinstance(value, list) and (value or not path):
+        return "list"
+    return "leaf"
+
+
+def iter_json_leaf_paths(path, value):
+    stack = [(path, value)]
+    while stack:
+        path, value = stack.pop()
+        kind = json_node_kind(path, value)
+        if kind == "dict":
+            stack.extend((json_child_path(path, key), item) for key, item in value.items())
+        elif kind == "list":
+            stack.extend((json_index_path(path, index), item) for index, item in enumerate(value))
+        elif kind == "leaf":
+            yield path or u"$"
+
+
+def iter_changed_json_paths(before, after):
+    """Walk two JSON documents together and yield the leaf paths whose values differ, in no particular order."""
+    stack = [(u"", before, after)]
+    while stack:
+        path, before, after = stack.pop()
+        before_kind = json_node_kind(path, before)
+        after_kind = json_node_kind(path, after)
+        if before_kind == after_kind == "dict":
+            for key in set(before) | set(after):
+                stack.append((json_child_path(path, key), before.get(key, JSON_MISSING), after.get(key, JSON_MISSING)))
+        elif before_kind == after_kind == "list":
+            for index in range(max(len(before), len(after))):
+                stack.append(
+                    (
+                        json_index_path(path, index),
+                        before[index] if index < len(before) else JSON_MISSING,
+                        after[index] if index < len(after) else JSON_MISSING,
+                    ),
+                )
+        elif before_kind == after_kind == "leaf":
+            if type(before) is not type(after) or before != after:
+                yield path or u"$"
+        else:
+            # Different shapes share no leaf path, so every leaf on either side changed.
+            for value in (before, after):
+                for leaf_path in iter_json_leaf_paths(path, value):
+                    yield leaf_path
 
 
 def extract_json_documents_from_snapshot(snapshot_value):
     if snapshot_value is None or snapshot_value.content is None:
         return None
 
-    header, rows = parse_snapshot_csv(snapshot_value.content)
+    header, rows = snapshot_value.parsed()
     documents = []
     for row in rows:
         parsed = None
@@ -743,14 +1280,13 @@ def extract_json_documents_from_snapshot(snapshot_value):
 def snapshot_row_count(snapshot_value):
     if snapshot_value is None or snapshot_value.content is None:
         return None
-    _, rows = parse_snapshot_csv(snapshot_value.content)
-    return len(rows)
+    return snapshot_value.row_count()
 
 
 def snapshot_header_columns(snapshot_value):
     if snapshot_value is None or snapshot_value.content is None:
         return []
-    header, _ = parse_snapshot_csv(snapshot_value.content)
+    header, _ = snapshot_value.parsed()
     columns = []
     for column in header:
         append_unique(columns, column)
@@ -760,7 +1296,7 @@ def snapshot_header_columns(snapshot_value):
 def snapshot_non_empty_columns(snapshot_value, sample_size=3):
     if snapshot_value is None or snapshot_value.content is None:
         return []
-    header, rows = parse_snapshot_csv(snapshot_value.content)
+    header, rows = snapshot_value.parsed()
     columns = []
     for row in rows[:sample_size]:
         for index, cell in enumerate(row):
@@ -789,62 +1325,157 @@ def changed_json_paths_from_snapshots(before_value, after_value):
     max_rows = max(len(before_documents), len(after_documents))
     changed = []
     for row_index in range(max_rows):
-        before_flat = flatten_json_paths(before_documents[row_index]) if row_index < len(before_documents) else {}
-        after_flat = flatten_json_paths(after_documents[row_index]) if row_index < len(after_documents) else {}
-        for path in sorted(set(before_flat.keys()) | set(after_flat.keys())):
-            if before_flat.get(path) != after_flat.get(path):
-                append_unique(changed, path)
+        before_document = before_documents[row_index] if row_index < len(before_documents) else {}
+        after_document = after_documents[row_index] if row_index < len(after_documents) else {}
+        for path in sorted(set(iter_changed_json_paths(before_document, after_document))):
+            append_unique(changed, path)
     return changed
 
 
-def changed_columns_from_snapshots(before_value, after_value):
+def snapshot_diff_columns(before_header, after_header):
+    """Match before/after header columns by name. Returns [name, before index, after index] entries."""
+    columns = []
+    unmatched_by_name = defaultdict(list)
+    for index, name in enumerate(before_header):
+        column = [name or u"column_%s" % (index + 1), index, None]
+        columns.append(column)
+        unmatched_by_name[column[0]].append(column)
+    for index, name in enumerate(after_header):
+        name = name or u"column_%s" % (index + 1)
+        if unmatched_by_name.get(name):
+            unmatched_by_name[name].pop(0)[2] = index
+        else:
+            columns.append([name, None, index])
+    return columns
+
+
+def project_snapshot_rows(rows, indexes):
+    width = len(indexes)
+    projected = []
+    for row in rows:
+        row_width = len(row)
+        projected.append(tuple(row[index] if index is not None and index < row_width else u"" for index in indexes))
+    return projected if width else [() for _ in rows]
+
+
+def unique_key_values(rows, positions):
+    values = [tuple(row[position] for position in positions) for row in rows]
+    if len(set(values)) != len(values) or any(not any(value) for value in values):
+        return None
+    return values
+
+
+def snapshot_key_positions(columns, before_rows, after_rows):
+    # Primary-key-like columns present on both sides with unique, non-empty values.
+    positions = [
+        position
+        for position, (name, before_index, after_index) in enumerate(columns)
+        if before_index is not None and after_index is not None and normalize_identifier(name) in SNAPSHOT_KEY_COLUMN_NAMES
+    ]
+    if not positions:
+        return None, None, None
+    before_keys = unique_key_values(before_rows, positions)
+    after_keys = unique_key_values(after_rows, positions)
+    if before_keys is None or after_keys is None:
+        return None, None, None
+    return positions, before_keys, after_keys
+
+
+def align_snapshot_rows(columns, before_rows, after_rows):
+    """Pair before/after rows by key columns when detected, otherwise by identical row content then position."""
+    empty = tuple(u"" for _ in columns)
+    positions, before_keys, after_keys = snapshot_key_positions(columns, before_rows, after_rows)
+    if positions is not None:
+        after_by_key = OrderedDict(zip(after_keys, after_rows))
+        pairs = [(row, after_by_key.pop(key, empty)) for key, row in zip(before_keys, before_rows)]
+        pairs.extend((empty, row) for row in after_by_key.values())
+        return pairs
+
+    unmatched_after = defaultdict(int)
+    for row in after_rows:
+        unmatched_after[row] += 1
+    pairs = []
+    changed_before = []
+    for row in before_rows:
+        if unmatched_after.get(row):
+            unmatched_after[row] -= 1
+            pairs.append((row, row))
+        else:
+            changed_before.append(row)
+    changed_after = []
+    for row in after_rows:
+        if unmatched_after.get(row):
+            unmatched_after[row] -= 1
+            changed_after.append(row)
+    for index in range(max(len(changed_before), len(changed_after))):
+        pairs.append(
+            (
+                changed_before[index] if index < len(changed_before) else empty,
+                changed_after[index] if index < len(changed_after) else empty,
+            ),
+        )
+    return pairs
+
+
+def diff_snapshot_columns(before_value, after_value):
+    """Return an ordered {column: changed row count} for changed columns, or None if the pair cannot be diffed."""
     if (
         before_value is None
         or after_value is None
         or before_value.content is None
         or after_value.content is None
     ):
-        return []
+        return None
 
-    before_header, before_rows = parse_snapshot_csv(before_value.content)
-    after_header, after_rows = parse_snapshot_csv(after_value.content)
+    before_header, before_rows = before_value.parsed()
+    after_header, after_rows = after_value.parsed()
     header_columns = []
     for column in before_header + after_header:
         append_unique(header_columns, column)
 
     if is_document_like_columns(header_columns):
-        return []
+        return None
 
     if not before_header and not after_header:
-        return []
+        return None
 
-    max_columns = max(len(before_header), len(after_header))
-    max_rows = max(len(before_rows), len(after_rows))
-    changed = []
-    for column_index in range(max_columns):
-        column_name = (
-            before_header[column_index]
-            if column_index < len(before_header) and before_header[column_index]
-            else (after_header[column_index] if column_index < len(after_header) else u"column_%s" % (column_index + 1))
-        )
-        different = False
-        for row_index in range(max_rows):
-            before_cell = (
-                before_rows[row_index][column_index]
-                if row_index < len(before_rows) and column_index < len(before_rows[row_index])
-                else u""
-            )
-            after_cell = (
-                after_rows[row_index][column_index]
-                if row_index < len(after_rows) and column_index < len(after_rows[row_index])
-                else u""
-            )
-            if before_cell != after_cell:
-                different = True
-                break
-        if different:
-            append_unique(changed, column_name)
-    return changed
+    columns = snapshot_diff_columns(before_header, after_header)
+    pairs = align_snapshot_rows(
+        columns,
+        project_snapshot_rows(before_rows, [before_index for _, before_index, _ in columns]),
+        project_snapshot_rows(after_rows, [after_index for _, _, after_index in columns]),
+    )
+    counts = OrderedDict()
+    if not pairs:
+        return counts
+    before_columns = list(zip(*[before for before, _ in pairs]))
+    after_columns = list(zip(*[after for _, after in pairs]))
+    for (name, _, _), before_cells, after_cells in zip(columns, before_columns, after_columns):
+        if before_cells == after_cells:
+            continue
+        counts[name] = counts.get(name, 0) + sum(1 for before_cell, after_cell in zip(before_cells, after_cells) if before_cell != after_cell)
+    return counts
+
+
+def snapshot_changed_columns(before_value, after_value):
+    """Return the changed columns of a before/after snapshot pair, as "column(changed rows)" when diffed."""
+    sampled_columns = []
+    for column in snapshot_non_empty_columns(before_value) + snapshot_non_empty_columns(after_value):
+        append_unique(sampled_columns, column)
+    if is_document_like_columns(sampled_columns):
+        # Document snapshots (one JSON column) report the changed JSON paths.
+        return changed_json_paths_from_snapshots(before_value, after_value)
+    if not sampled_columns:
+        header_columns = []
+        for column in snapshot_header_columns(before_value) + snapshot_header_columns(after_value):
+            append_unique(header_columns, column)
+        if is_document_like_columns(header_columns):
+            return changed_json_paths_from_snapshots(before_value, after_value)
+    counts = diff_snapshot_columns(before_value, after_value)
+    if counts is None:
+        # Not diffable (no header, or content missing): list the non-empty columns.
+        return sampled_columns
+    return [u"%s(%s)" % (column, count) for column, count in counts.items()]
 
 
 def format_scoped_values(items):
@@ -866,9 +1497,9 @@ def build_blank_enrichment():
     return [u""] * len(ENRICHMENT_KEYS)
 
 
-def build_error_enrichment(audit, audit_index, message):
+def build_error_enrichment(audit, audit_index, message, query_text_max_bytes=QUERY_TEXT_MAX_BYTES):
     try:
-        query_text = decode_query_text(audit.compressed_full_query_text, audit.short_query_text)
+        query_text = decode_query_text(audit.compressed_full_query_text, audit.short_query_text, query_text_max_bytes)
     except Exception:
         query_text = audit.short_query_text or u""
     return [
@@ -913,10 +1544,16 @@ def build_enrichment_for_audit(
     large_file_mode,
     output_dir,
     connection_database,
-    ledger_data,
+    ledger_index,
     include_dml_snapshots,
+    blob_contents=None,
+    snapshot_cache=None,
+    query_text_max_bytes=QUERY_TEXT_MAX_BYTES,
+    snapshot_plan=None,
 ):
-    query_text = decode_query_text(audit.compressed_full_query_text, audit.short_query_text)
+    query_text = decode_query_text(audit.compressed_full_query_text, audit.short_query_text, query_text_max_bytes)
+    if include_dml_snapshots and snapshot_plan is None:
+        snapshot_plan = plan_snapshot_cells(audit, blob_meta, threshold, large_file_mode)
     before_values = []
     after_values = []
     target_objects = parse_target_object_names(audit.target_object_names_csv)
@@ -927,7 +1564,8 @@ def build_enrichment_for_audit(
     matched_ledger_tables = []
     ledger_table_created_ats = []
     ledger_table_updated_ats = []
-    snapshot_cache = {}
+    if snapshot_cache is None:
+        snapshot_cache = SnapshotCache(max_bytes=None)
     connection_name, fallback_database_name = parse_connection_database(connection_database)
     for change in parse_data_changes(audit.data_changes_json):
         old_uuid = change.get("oldDataSnapshotUuid")
@@ -946,6 +1584,8 @@ def build_enrichment_for_audit(
                 large_file_mode,
                 output_dir,
                 snapshot_cache,
+                blob_contents,
+                snapshot_plan,
             )
             before_values.append(before_value)
         if include_dml_snapshots and is_text(new_uuid) and new_uuid.strip():
@@ -957,23 +1597,14 @@ def build_enrichment_for_audit(
                 large_file_mode,
                 output_dir,
                 snapshot_cache,
+                blob_contents,
+                snapshot_plan,
             )
             after_values.append(after_value)
 
         changed_columns = []
         if include_dml_snapshots and before_value is not None and after_value is not None:
-            for column in snapshot_non_empty_columns(before_value) + snapshot_non_empty_columns(after_value):
-                append_unique(changed_columns, column)
-            if is_document_like_columns(changed_columns):
-                changed_columns = []
-            elif not changed_columns:
-                fallback_columns = []
-                for column in snapshot_header_columns(before_value) + snapshot_header_columns(after_value):
-                    append_unique(fallback_columns, column)
-                if is_document_like_columns(fallback_columns):
-                    changed_columns = []
-                else:
-                    changed_columns = changed_columns_from_snapshots(before_value, after_value)
+            changed_columns = snapshot_changed_columns(before_value, after_value)
         if changed_columns:
             scoped_columns.append((target_object, u", ".join(changed_columns)))
 
@@ -984,29 +1615,24 @@ def build_enrichment_for_audit(
             if row_counts:
                 scoped_row_counts.append((target_object, to_text(max(row_counts))))
 
-        change_summaries.append(
-            json.dumps(
-                {
-                    "queryAuditUuid": audit.query_audit_uuid,
-                    "type": change.get("type"),
-                    "targetObject": change.get("targetObject"),
-                    "oldDataSnapshotUuid": old_uuid,
-                    "newDataSnapshotUuid": new_uuid,
-                },
-                ensure_ascii=False,
-            ),
-        )
-
-    before = render_snapshot_values(before_values, threshold)
-    after = render_snapshot_values(after_values, threshold)
+        change_summary = {
+            "queryAuditUuid": audit.query_audit_uuid,
+            "type": change.get("type"),
+            "targetObject": change.get("targetObject"),
+            "oldDataSnapshotUuid": old_uuid,
+            "newDataSnapshotUuid": new_uuid,
+        }
+        change_summaries.append(json.dumps(change_summary, ensure_ascii=False))
+
+    before = render_snapshot_values(before_values, threshold, snapshot_plan.before_bytes if snapshot_plan else None)
+    after = render_snapshot_values(after_values, threshold, snapshot_plan.after_bytes if snapshot_plan else None)
     for target_object in target_objects:
         _, database_name, schema_name, table_name = parse_query_table(target_object, fallback_database_name)
-        is_ledger, matched_table, created_at, updated_at = find_ledger_match(
+        is_ledger, matched_table, created_at, updated_at = ledger_index.match(
             connection_name,
             database_name,
             schema_name,
             table_name,
-            ledger_data,
         )
         ledger_matches.append((target_object, u"Y" if is_ledger else u"N"))
         if is_ledger:
@@ -1163,24 +1789,7 @@ def final_output_header(internal_columns, column_specs):
     return headers
 
 
-def main():
-    args = parse_args()
-    add_vendor_dir(args.vendor_dir)
-
-    header, rows = read_csv(args.input, args.header, args.encoding)
-    if header is None:
-        raise SystemExit("--header is required for final audit column mapping.")
-    workflow_col_index = resolve_workflow_column(rows, header, args.workflow_column)
-    header_index = build_header_index(header)
-
-    workflow_uuids = sorted(
-        set(
-            normalize_uuid(row[workflow_col_index])
-            for row in rows
-            if len(row) > workflow_col_index and normalize_uuid(row[workflow_col_index])
-        ),
-    )
-
+def db_configs_from_args(args):
     log_db = DbConfig(
         host=args.log_db_host,
         port=args.log_db_port,
@@ -1202,102 +1811,396 @@ def main():
         password=args.app_db_password,
         database=args.app_db_name,
     )
+    return log_db, snapshot_db, app_db
+
+
+class EnrichmentContext(object):
+    """Connections, ledger targets and output options shared by every enriched file of a run."""
+
+    def __init__(self, args, workers=None):
+        self.args = args
+        self.workers = args.workers if workers is None else workers
+        self.log_db, self.snapshot_db, self.app_db = db_configs_from_args(args)
+        self.connections = ConnectionManager(connect)
+        self.log_conn = None
+        self.snapshot_conn = None
+        self.app_conn = None
+        self.ledger_index = None
+        self.metadata_cache = None
+        self.snapshot_cache = SnapshotCache(args.snapshot_cache_bytes)
+        self.audit_batch = None
+        self.blob_meta_batch = None
+        if args.lookup_target_seconds > 0:
+            self.audit_batch = AdaptiveBatchSize(args.batch_size, args.min_batch_size, args.max_batch_size, args.lookup_target_seconds)
+            self.blob_meta_batch = AdaptiveBatchSize(args.batch_size, args.min_batch_size, args.max_batch_size, args.lookup_target_seconds)
+        self.worker_reconnects = 0
+        self.pool = None
+        self.internal_columns = selected_internal_columns(args)
+        self.column_specs = final_column_specs(args.include_dml_snapshots)
+        self.output_header = final_output_header(self.internal_columns, self.column_specs)
+
+    def open(self):
+        if self.workers > 1:
+            # Fork before any connection is opened so workers share no sockets.
+            self.pool = open_enrichment_pool(self.args, self.workers)
+        self.log_conn = self.connections.get(self.log_db)
+        self.snapshot_conn = self.connections.get(self.snapshot_db) if self.args.include_dml_snapshots else None
+        self.app_conn = self.connections.get(self.app_db)
+        if self.args.metadata_cache:
+            self.metadata_cache = MetadataCache(self.args.metadata_cache)
+        self.ledger_index = read_ledger_targets(self.app_conn, self.metadata_cache, db_cache_key(self.app_db))
+
+    def add_worker_counts(self, counts):
+        self.snapshot_cache.hits += counts.get("snapshot_cache_hits", 0)
+        self.snapshot_cache.misses += counts.get("snapshot_cache_misses", 0)
+        self.snapshot_cache.evictions += counts.get("snapshot_cache_evictions", 0)
+        self.worker_reconnects += counts.get("db_reconnects", 0)
+        if "audit_batch_size" in counts:
+            # Later row batches follow the size the workers arrived at.
+            self.audit_batch.set_size(counts["audit_batch_size"])
+            self.blob_meta_batch.set_size(counts["blob_meta_batch_size"])
+        if self.metadata_cache is not None:
+            self.metadata_cache.blob_meta_hits += counts.get("blob_meta_cache_hits", 0)
+            self.metadata_cache.blob_meta_misses += counts.get("blob_meta_cache_misses", 0)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.connections.close_all()
+        if self.metadata_cache is not None:
+            self.metadata_cache.close()
+            self.metadata_cache = None
+        self.log_conn = None
+        self.snapshot_conn = None
+        self.app_conn = None
+
+
+def batch_workflow_uuids(row_batch, workflow_col_index):
+    return sorted(
+        set(
+            normalize_uuid(row[workflow_col_index])
+            for row in row_batch
+            if len(row) > workflow_col_index and normalize_uuid(row[workflow_col_index])
+        ),
+    )
+
 
-    log_conn = connect(log_db)
-    snapshot_conn = connect(snapshot_db) if args.include_dml_snapshots else None
-    app_conn = connect(app_db)
-    output_fp = None
+def explain_enrichment_queries(context, rows, workflow_col_index):
+    """Print EXPLAIN reports for the lookups of the first row batch. Returns the number of findings."""
+    args = context.args
+    row_batch = next(row_batches(rows, workflow_col_index, args.batch_size), [])
+    workflow_uuids = batch_workflow_uuids(row_batch, workflow_col_index)
+    if not workflow_uuids:
+        print("No workflow UUIDs in the first batch. Nothing to explain.")
+        return 0
+    cursor = cursor_for(context.log_conn)
     try:
-        ledger_data = read_ledger_targets(app_conn)
-        internal_columns = selected_internal_columns(args)
-        column_specs = final_column_specs(args.include_dml_snapshots)
-        output_header = final_output_header(internal_columns, column_specs)
-
-        output_fp, output_writer = open_csv_writer(args.output, args.encoding)
-        write_csv_row(output_writer, output_header, args.encoding)
-
-        found_audits = 0
-        snapshot_uuid_count = 0
-        output_row_count = 0
-        for row_batch in row_batches(rows, workflow_col_index, args.batch_size):
-            print("Gathering...", file=sys.stderr)
-            batch_workflow_uuids = sorted(
-                set(
-                    normalize_uuid(row[workflow_col_index])
-                    for row in row_batch
-                    if len(row) > workflow_col_index and normalize_uuid(row[workflow_col_index])
-                ),
+        plan = explain_plan(cursor, QUERY_AUDITS_SQL.format(ids=placeholders(len(workflow_uuids))), workflow_uuids)
+    finally:
+        cursor.close()
+    findings = print_explain_report("query audits", plan, QUERY_AUDIT_INDEX_SUGGESTIONS)
+    if not args.include_dml_snapshots:
+        return findings
+    audits_by_workflow = read_query_audits(context.log_conn, workflow_uuids, args.batch_size)
+    names = sorted(collect_snapshot_uuids(audits_by_workflow))[: args.batch_size]
+    if not names:
+        print("No DML snapshots in the first batch. Snapshot queries are not explained.")
+        return findings
+    cursor = cursor_for(context.snapshot_conn)
+    try:
+        for label, sql, suggestions in (
+            ("blob meta", BLOB_META_SQL, BLOB_META_INDEX_SUGGESTIONS),
+            ("blob contents", BLOB_CONTENTS_SQL, BLOB_CONTENTS_INDEX_SUGGESTIONS),
+        ):
+            findings += print_explain_report(label, explain_plan(cursor, sql.format(ids=placeholders(len(names))), names), suggestions)
+    finally:
+        cursor.close()
+    return findings
+
+
+def enrich_batch(context, header_index, row_batch, workflow_col_index, snapshot_output_dir):
+    """Return (output rows, counts) for one row batch, in input row order."""
+    args = context.args
+    print("Gathering...", file=sys.stderr)
+    workflow_uuids = batch_workflow_uuids(row_batch, workflow_col_index)
+    if workflow_uuids:
+        audits_by_workflow = read_query_audits(context.log_conn, workflow_uuids, args.batch_size, context.audit_batch)
+    else:
+        audits_by_workflow = {}
+    snapshot_uuids = collect_snapshot_uuids(audits_by_workflow) if args.include_dml_snapshots else set()
+    blob_meta = {}
+    if args.include_dml_snapshots:
+        blob_meta = read_blob_meta(
+            context.snapshot_conn,
+            snapshot_uuids,
+            args.batch_size,
+            context.metadata_cache,
+            db_cache_key(context.snapshot_db),
+            context.blob_meta_batch,
+        )
+    blob_contents = {}
+    snapshot_plans = {}
+    if args.include_dml_snapshots:
+        content_names = set()
+        for audits in audits_by_workflow.values():
+            for audit in audits:
+                plan = plan_snapshot_cells(audit, blob_meta, args.inline_threshold_bytes, args.large_file_mode)
+                snapshot_plans[audit.query_audit_uuid] = plan
+                content_names.update(plan.content_names)
+        blob_contents = read_blob_contents(
+            context.snapshot_conn,
+            [
+                name
+                for name in inline_snapshot_names(blob_meta, args.inline_threshold_bytes)
+                if name in content_names and (name, None) not in context.snapshot_cache
+            ],
+            blob_meta,
+            args.batch_size,
+        )
+
+    output_rows = []
+    skipped_rows = 0
+    for row in row_batch:
+        print("Processing...", file=sys.stderr)
+        workflow_uuid = normalize_uuid(row[workflow_col_index]) if len(row) > workflow_col_index else u""
+        audits = audits_by_workflow.get(workflow_uuid, [])
+        if not audits:
+            if args.skip_unaudited_workflows:
+                skipped_rows += 1
+                continue
+            output_rows.append(
+                build_final_row(row, header_index, build_blank_enrichment(), context.internal_columns, workflow_uuid, context.column_specs),
             )
-            if batch_workflow_uuids:
-                audits_by_workflow = read_query_audits(log_conn, batch_workflow_uuids, args.batch_size)
-            else:
-                audits_by_workflow = {}
-            snapshot_uuids = collect_snapshot_uuids(audits_by_workflow) if args.include_dml_snapshots else set()
-            blob_meta = read_blob_meta(snapshot_conn, snapshot_uuids, args.batch_size) if args.include_dml_snapshots else {}
-            found_audits += sum(len(value) for value in audits_by_workflow.values())
-            snapshot_uuid_count += len(snapshot_uuids)
-
-            for row in row_batch:
-                print("Processing...", file=sys.stderr)
-                workflow_uuid = normalize_uuid(row[workflow_col_index]) if len(row) > workflow_col_index else u""
-                audits = audits_by_workflow.get(workflow_uuid, [])
-                if not audits:
-                    write_csv_row(
-                        output_writer,
-                        build_final_row(row, header_index, build_blank_enrichment(), internal_columns, workflow_uuid, column_specs),
-                        args.encoding,
-                    )
-                    output_row_count += 1
-                    continue
-
-                for index, audit in enumerate(audits, 1):
-                    try:
-                        connection_database = get_base_value(
-                            row,
-                            header_index,
-                            [u"Connection/DB명", u"DB명 (Connection/DB)", u"DB명", u"Connection / Database"],
-                        )
-                        enrichment_values = build_enrichment_for_audit(
-                            audit,
-                            index,
-                            snapshot_conn,
-                            blob_meta,
-                            args.inline_threshold_bytes,
-                            args.large_file_mode,
-                            args.snapshot_output_dir,
-                            connection_database,
-                            ledger_data,
-                            args.include_dml_snapshots,
-                        )
-                    except Exception:
-                        log_audit_processing_error(workflow_uuid, audit, index)
-                        enrichment_values = build_error_enrichment(
-                            audit,
-                            index,
-                            u"DML snapshot 처리 중 오류가 발생했습니다. stderr 로그를 확인하세요.",
-                        )
-                    write_csv_row(
-                        output_writer,
-                        build_final_row(row, header_index, enrichment_values, internal_columns, workflow_uuid, column_specs),
-                        args.encoding,
-                    )
-                    output_row_count += 1
-
-        print("workflow rows: %s" % len(rows))
-        print("unique workflow uuids: %s" % len(workflow_uuids))
-        print("query audit rows: %s" % found_audits)
-        print("snapshot uuids processed: %s" % snapshot_uuid_count)
-        print("ledger table targets: %s" % len(ledger_data[0]))
-        print("output rows: %s" % output_row_count)
-        print("output: %s" % args.output)
+            continue
+
+        for index, audit in enumerate(audits, 1):
+            try:
+                connection_database = get_base_value(
+                    row,
+                    header_index,
+                    [u"Connection/DB명", u"DB명 (Connection/DB)", u"DB명", u"Connection / Database"],
+                )
+                enrichment_values = build_enrichment_for_audit(
+                    audit,
+                    index,
+                    context.snapshot_conn,
+                    blob_meta,
+                    args.inline_threshold_bytes,
+                    args.large_file_mode,
+                    snapshot_output_dir,
+                    connection_database,
+                    context.ledger_index,
+                    args.include_dml_snapshots,
+                    blob_contents,
+                    context.snapshot_cache,
+                    args.query_text_max_bytes,
+                    snapshot_plans.get(audit.query_audit_uuid),
+                )
+            except Exception:
+                log_audit_processing_error(workflow_uuid, audit, index)
+                enrichment_values = build_error_enrichment(
+                    audit,
+                    index,
+                    u"DML snapshot 처리 중 오류가 발생했습니다. stderr 로그를 확인하세요.",
+                    args.query_text_max_bytes,
+                )
+            output_rows.append(
+                build_final_row(row, header_index, enrichment_values, context.internal_columns, workflow_uuid, context.column_specs),
+            )
+    counts = {
+        "query_audit_rows": sum(len(value) for value in audits_by_workflow.values()),
+        "snapshot_uuids": len(snapshot_uuids),
+        "skipped_workflow_rows": skipped_rows,
+    }
+    return output_rows, counts
+
+
+WORKER_ARGS = None
+WORKER_CONTEXT = None
+
+
+class WorkerExit(Exception):
+    """SystemExit raised in a pool worker, passed back to the parent as an ordinary exception.
+
+    Pool workers only report Exception subclasses; a SystemExit ends the
+    worker, the pool replaces it and the parent waits for the result forever.
+    """
+
+
+def open_enrichment_pool(args, workers):
+    return multiprocessing.Pool(processes=workers, initializer=init_enrichment_worker, initargs=(args,))
+
+
+def init_enrichment_worker(args):
+    # Connections are opened with the first batch, so a failure reaches the parent as that batch's error.
+    global WORKER_ARGS
+    WORKER_ARGS = args
+
+
+def open_worker_context():
+    global WORKER_CONTEXT
+    if WORKER_CONTEXT is None:
+        context = EnrichmentContext(WORKER_ARGS, workers=1)
+        try:
+            context.open()
+        except BaseException:
+            context.close()
+            raise
+        WORKER_CONTEXT = context
+    return WORKER_CONTEXT
+
+
+def worker_result(async_result):
+    try:
+        return async_result.get()
+    except WorkerExit as exc:
+        raise SystemExit(exc.args[0] if exc.args else None)
+
+
+def enrich_batch_in_worker(task):
+    try:
+        return enrich_worker_batch(open_worker_context(), task)
+    except SystemExit as exc:
+        raise WorkerExit(exc.code)
+
+
+def enrich_worker_batch(context, task):
+    header_index, row_batch, workflow_col_index, snapshot_output_dir = task
+    cache = context.snapshot_cache
+    metadata_cache = context.metadata_cache
+    before = (cache.hits, cache.misses, cache.evictions, context.connections.reconnect_count())
+    if metadata_cache is not None:
+        before += (metadata_cache.blob_meta_hits, metadata_cache.blob_meta_misses)
+    output_rows, counts = enrich_batch(context, header_index, row_batch, workflow_col_index, snapshot_output_dir)
+    counts["snapshot_cache_hits"] = cache.hits - before[0]
+    counts["snapshot_cache_misses"] = cache.misses - before[1]
+    counts["snapshot_cache_evictions"] = cache.evictions - before[2]
+    counts["db_reconnects"] = context.connections.reconnect_count() - before[3]
+    if metadata_cache is not None:
+        counts["blob_meta_cache_hits"] = metadata_cache.blob_meta_hits - before[4]
+        counts["blob_meta_cache_misses"] = metadata_cache.blob_meta_misses - before[5]
+    if context.audit_batch is not None:
+        counts["audit_batch_size"] = context.audit_batch.size
+        counts["blob_meta_batch_size"] = context.blob_meta_batch.size
+    return output_rows, counts
+
+
+def enrich_rows(context, header, rows, workflow_col_index, output_path, encoding):
+    """Write the enriched rows to output_path in --format and return processing counts.
+
+    rows may be any iterable, such as a CSV reader. Only one row batch is held
+    in memory, or two per worker with --workers. Output keeps input row order.
+    """
+    args = context.args
+    header_index = build_header_index(header)
+    snapshot_output_dir = args.snapshot_output_dir
+    if args.large_file_mode == "file" and not snapshot_output_dir:
+        snapshot_output_dir = output_path + ".snapshots"
+    stats = {
+        "workflow_rows": 0,
+        "unique_workflow_uuids": 0,
+        "query_audit_rows": 0,
+        "snapshot_uuids": 0,
+        "output_rows": 0,
+        "skipped_workflow_rows": 0,
+        "write_rate": 0,
+    }
+    workflow_uuids = set()
+    pending = deque()
+    output_writer = None
+
+    def write_batch(result):
+        output_rows, counts = result
+        output_writer.write_rows(output_rows)
+        stats["output_rows"] += len(output_rows)
+        stats["query_audit_rows"] += counts["query_audit_rows"]
+        stats["skipped_workflow_rows"] += counts["skipped_workflow_rows"]
+        stats["snapshot_uuids"] += counts["snapshot_uuids"]
+        context.add_worker_counts(counts)
+
+    try:
+        output_writer = open_row_writer(output_path, context.output_header, args.format, encoding)
+
+        batch_size = context.audit_batch if context.audit_batch is not None else args.batch_size
+        for row_batch in row_batches(rows, workflow_col_index, batch_size):
+            stats["workflow_rows"] += len(row_batch)
+            workflow_uuids.update(batch_workflow_uuids(row_batch, workflow_col_index))
+            if context.pool is None:
+                write_batch(enrich_batch(context, header_index, row_batch, workflow_col_index, snapshot_output_dir))
+                continue
+            task = (header_index, row_batch, workflow_col_index, snapshot_output_dir)
+            pending.append(context.pool.apply_async(enrich_batch_in_worker, (task,)))
+            while len(pending) > 2 * args.workers:
+                write_batch(worker_result(pending.popleft()))
+        while pending:
+            write_batch(worker_result(pending.popleft()))
+    finally:
+        if output_writer is not None:
+            output_writer.close()
+    stats["unique_workflow_uuids"] = len(workflow_uuids)
+    stats["write_rate"] = rows_per_second(output_writer.rows, output_writer.write_seconds)
+    return stats
+
+
+def print_enrichment_summary(context, stats, output_path):
+    print("workflow rows: %s" % stats["workflow_rows"])
+    print("unique workflow uuids: %s" % stats["unique_workflow_uuids"])
+    print("query audit rows: %s" % stats["query_audit_rows"])
+    print("snapshot uuids processed: %s" % stats["snapshot_uuids"])
+    print("ledger table targets: %s" % len(context.ledger_index))
+    print("output rows: %s" % stats["output_rows"])
+    if context.args.skip_unaudited_workflows:
+        print("skipped workflow rows without audits: %s" % stats["skipped_workflow_rows"])
+    print("write rate: %s rows/sec" % stats["write_rate"])
+    print("db reconnects: %s" % (context.connections.reconnect_count() + context.worker_reconnects))
+    if context.audit_batch is not None:
+        sizers = [("query audit", context.audit_batch)]
+        if context.args.include_dml_snapshots:
+            sizers.append(("blob_meta", context.blob_meta_batch))
+        for label, sizer in sizers:
+            print("%s batch size: %s (range %s-%s)" % (label, sizer.size, sizer.smallest, sizer.largest))
+    if context.args.include_dml_snapshots:
+        cache = context.snapshot_cache
+        print("snapshot cache hits: %s, misses: %s, evictions: %s" % (cache.hits, cache.misses, cache.evictions))
+    metadata_cache = context.metadata_cache
+    if metadata_cache is not None:
+        print(
+            "metadata cache ledger hits: %s, misses: %s; blob_meta hits: %s, misses: %s"
+            % (
+                metadata_cache.ledger_hits,
+                metadata_cache.ledger_misses,
+                metadata_cache.blob_meta_hits,
+                metadata_cache.blob_meta_misses,
+            )
+        )
+    print("output: %s" % output_path)
+
+
+def main():
+    args = parse_args()
+    add_vendor_dir(args.vendor_dir)
+
+    output_path = args.output
+    if args.format != "csv":
+        output_path = format_output_path(output_path, args.format)
+    input_fp, header, rows = open_csv_reader(args.input, args.header, args.encoding)
+    context = EnrichmentContext(args, workers=1 if args.explain else None)
+    try:
+        if header is None:
+            raise SystemExit("--header is required for final audit column mapping.")
+        workflow_col_index = resolve_workflow_column(header, args.workflow_column)
+        context.open()
+        if args.explain:
+            print("explain findings: %s" % explain_enrichment_queries(context, rows, workflow_col_index))
+            return 0
+        stats = enrich_rows(context, header, rows, workflow_col_index, output_path, args.encoding)
+        print_enrichment_summary(context, stats, output_path)
         return 0
     finally:
-        if output_fp is not None:
-            output_fp.close()
-        log_conn.close()
-        if snapshot_conn is not None:
-            snapshot_conn.close()
-        app_conn.close()
+        context.close()
+        input_fp.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export SQL workflow requests and enrich them with Query Audit data in one process.
+
+Python 2.7 compatible. This is the streaming equivalent of running
+export_workflow_sql_requests.py and then enrich_workflow_sql_audit.py once per
+split file: exported rows are handed to the enrichment stage in memory, the
+DB connections are opened once and ledger targets are read once, and the same
+result/output_workflow.NNN.csv files are written without intermediate CSVs.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import enrich_workflow_sql_audit as enricher
+import export_workflow_sql_requests as exporter
+from audit_db import ConnectionManager
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export SQL workflow requests and write enriched audit CSV files.")
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Export base path such as workflows/workflow.csv. Split file names are derived from it.",
+    )
+    parser.add_argument(
+        "--result-dir",
+        default=None,
+        help="Directory for output_<split file name> results. Default: result/ next to --output.",
+    )
+    parser.add_argument(
+        "--rows-per-file",
+        type=int,
+        default=200,
+        help="Maximum workflow rows per output file. Use 0 to disable splitting. Default: 200.",
+    )
+    parser.add_argument(
+        "--from-kst",
+        default="2020-06-01 00:00:00",
+        help="Requested-at start time in KST. Inclusive. Default: 2020-06-01 00:00:00.",
+    )
+    parser.add_argument(
+        "--to-kst",
+        default="2026-08-01 00:00:00",
+        help="Requested-at end time in KST. Exclusive. Default: 2026-08-01 00:00:00.",
+    )
+    parser.add_argument("--fetch-size", type=int, default=1000, help="Rows to fetch per DB round-trip. Default: 1000.")
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Workflows read per keyset page. Each page is fetched completely before it is enriched. Default: 1000.",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=None,
+        help="Incremental export state. See export_workflow_sql_requests.py. Only workflows not exported before are enriched, into output files numbered after the previous run's.",
+    )
+    parser.add_argument(
+        "--state-lookback-days",
+        type=int,
+        default=exporter.STATE_LOOKBACK_DAYS,
+        help="Days before the newest exported workflow scanned again with --state-file. See export_workflow_sql_requests.py. Default: %s." % exporter.STATE_LOOKBACK_DAYS,
+    )
+    parser.add_argument(
+        "--approval-pivot",
+        choices=("server", "client"),
+        default="server",
+        help="Where approval step columns are built. See export_workflow_sql_requests.py. Default: server.",
+    )
+    parser.add_argument(
+        "--link-pattern",
+        action="append",
+        default=[],
+        help="Extra regular expression reported in the change request link column. See export_workflow_sql_requests.py.",
+    )
+    parser.add_argument(
+        "--approval-rule-name",
+        action="append",
+        default=[],
+        help="Filter by approval rule name. Accepts comma-separated names and can be specified multiple times. Default: all approval rule names.",
+    )
+    enricher.add_enrichment_arguments(parser)
+    args = parser.parse_args()
+    enricher.validate_enrichment_args(args)
+    if args.rows_per_file < 0:
+        raise SystemExit("--rows-per-file must be 0 or greater.")
+    if args.page_size <= 0:
+        raise SystemExit("--page-size must be greater than 0.")
+    if args.state_lookback_days < 0:
+        raise SystemExit("--state-lookback-days must be 0 or greater.")
+    if args.result_dir is None:
+        args.result_dir = os.path.join(os.path.dirname(args.output), "result")
+    exporter.build_link_extractor(args.link_pattern)
+    args.approval_rule_name = exporter.split_approval_rule_names(args.approval_rule_name)
+    return args
+
+
+def iter_exported_rows(
+    cursor,
+    approval_cursor,
+    approval_rule_names,
+    params,
+    page_size,
+    fetch_size,
+    overflow_workflow_ids,
+    link_extractor=None,
+):
+    # Each page is buffered so no unbuffered result stays open on the server
+    # while the enrichment stage works on the rows.
+    for range_params, keyset in exporter.iter_keyset_pages(cursor, approval_rule_names, params, 0, page_size):
+        page = list(
+            exporter.iter_export_range(
+                cursor,
+                approval_cursor,
+                approval_rule_names,
+                range_params,
+                fetch_size,
+                exporter.SERVER_APPROVAL_STEPS,
+                keyset,
+                overflow_workflow_ids,
+                link_extractor,
+            ),
+        )
+        for row in page:
+            yield [exporter.to_text(cell) for cell in row]
+
+
+def iter_row_chunks(rows, rows_per_file):
+    """Group rows like the exporter's split files. An empty export still yields one empty chunk."""
+    chunk = []
+    emitted = False
+    for row in rows:
+        chunk.append(row)
+        if rows_per_file > 0 and len(chunk) >= rows_per_file:
+            yield chunk
+            emitted = True
+            chunk = []
+    if chunk or not emitted:
+        yield chunk
+
+
+def explain_pipeline(args, context, export_connections, params, state, rows, workflow_col_index):
+    explain_cursor = export_connections.get(context.app_db, purpose="explain", on_connect=exporter.prepare_session).cursor()
+    try:
+        findings = exporter.explain_export_queries(
+            explain_cursor,
+            args.approval_rule_name,
+            params,
+            page_size=args.page_size,
+            client_pivot=args.approval_pivot == "client",
+        )
+    finally:
+        explain_cursor.close()
+    # The first batch is read through the export queries, like a real run.
+    findings += enricher.explain_enrichment_queries(context, rows, workflow_col_index)
+    print("explain findings: %s" % findings)
+    return 0
+
+
+def main():
+    args = parse_args()
+    exporter.add_vendor_dir(args.vendor_dir)
+
+    from_kst = exporter.parse_kst_datetime(args.from_kst)
+    to_kst = exporter.parse_kst_datetime(args.to_kst)
+    if from_kst >= to_kst:
+        raise SystemExit("--from-kst must be earlier than --to-kst")
+    from_utc = from_kst - exporter.KST_OFFSET
+    to_utc = to_kst - exporter.KST_OFFSET
+    state = None
+    if args.state_file:
+        state = exporter.load_export_state(args.state_file, args.output, args.approval_rule_name, exporter.SERVER_APPROVAL_STEPS)
+        from_utc = exporter.export_state_from_utc(state, from_utc)
+    first_file_index = state["file_count"] + 1 if state is not None else 1
+    params = [exporter.format_datetime(from_utc), exporter.format_datetime(to_utc)] + args.approval_rule_name
+
+    header = exporter.export_header(exporter.SERVER_APPROVAL_STEPS)
+    workflow_col_index = header.index(u"workflow_uuid")
+    context = enricher.EnrichmentContext(args, workers=1 if args.explain else None)
+    export_connections = ConnectionManager(exporter.connect)
+    cursor = None
+    approval_cursor = None
+    overflow_workflow_ids = set()
+    exported_rows = 0
+    output_rows = 0
+    output_paths = []
+    exported = []
+    try:
+        context.open()
+        cursor = export_connections.get(context.app_db, on_connect=exporter.prepare_session, streaming=True).cursor()
+        if args.approval_pivot == "client":
+            approval_cursor = export_connections.get(context.app_db, purpose="approval", streaming=True).cursor()
+
+        rows = iter_exported_rows(
+            cursor,
+            approval_cursor,
+            args.approval_rule_name,
+            params,
+            args.page_size,
+            args.fetch_size,
+            overflow_workflow_ids,
+            link_extractor=exporter.build_link_extractor(args.link_pattern),
+        )
+        if state is not None:
+            rows = exporter.skip_exported_rows(rows, state)
+        if args.explain:
+            return explain_pipeline(args, context, export_connections, params, state, rows, workflow_col_index)
+        for file_index, chunk in enumerate(iter_row_chunks(rows, args.rows_per_file), first_file_index):
+            if not chunk and file_index > 1:
+                # Nothing new since the previous incremental run.
+                break
+            input_name = os.path.basename(exporter.split_output_path(args.output, file_index, args.format))
+            output_path = os.path.join(args.result_dir, "output_%s" % input_name)
+            print(" == Process %s ==" % input_name)
+            stats = enricher.enrich_rows(context, header, chunk, workflow_col_index, output_path, args.encoding)
+            enricher.print_enrichment_summary(context, stats, output_path)
+            exported_rows += stats["workflow_rows"]
+            output_rows += stats["output_rows"]
+            output_paths.append(output_path)
+            if state is not None:
+                exported.extend((row[0], row[3]) for row in chunk)
+        if state is not None:
+            exporter.record_export_state(args.state_file, state, exported, exported_rows, len(output_paths), args.state_lookback_days)
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if approval_cursor is not None:
+            approval_cursor.close()
+        export_connections.close_all()
+        context.close()
+
+    print(" == Summary ==")
+    print("from_kst: %s" % exporter.format_datetime(from_kst))
+    print("to_kst: %s" % exporter.format_datetime(to_kst))
+    print("exported rows: %s" % exported_rows)
+    print("output rows: %s" % output_rows)
+    print("output files: %s" % len(output_paths))
+    if args.state_file:
+        print("state: %s" % args.state_file)
+    if overflow_workflow_ids:
+        print(
+            "WARNING: %s workflows have approval steps beyond %s and were truncated."
+            % (len(overflow_workflow_ids), exporter.SERVER_APPROVAL_STEPS),
+            file=sys.stderr,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
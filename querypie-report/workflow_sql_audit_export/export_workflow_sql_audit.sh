@@ -4,8 +4,56 @@ FROM="2025-07-01 00:00:00"
 TO="2026-07-01 00:00:00"
 # Leave empty to export every approval rule. Use commas for multiple names.
 APPROVAL_RULE_NAMES=""
+# Extra regular expressions reported in the change request link column, one
+# array element per pattern, e.g. ('INC[0-9]{7}' 'https://tool\.example\.com/[^ ]+').
+LINK_PATTERNS=()
 # Set to true to include DML snapshot before/after data in the output.
 INCLUDE_DML_SNAPSHOTS="${INCLUDE_DML_SNAPSHOTS:-false}"
+# Set to true to leave workflows without Query Audit rows out of the result
+# instead of writing a blank audit row for them.
+SKIP_UNAUDITED_WORKFLOWS="${SKIP_UNAUDITED_WORKFLOWS:-false}"
+# Set to true to export and enrich in a single process without intermediate
+# workflow.NNN.csv files. DB connections and ledger targets are loaded once.
+STREAMING_PIPELINE="${STREAMING_PIPELINE:-false}"
+# Set to a positive number to export in keyset pages of that many workflows.
+# A checkpoint file recording every fully written workflow.NNN.csv file is
+# kept next to the output.
+EXPORT_PAGE_SIZE="${EXPORT_PAGE_SIZE:-0}"
+# Set to true to continue an interrupted EXPORT_PAGE_SIZE export from its
+# checkpoint. By default every run starts a fresh export and checkpoint.
+EXPORT_RESUME="${EXPORT_RESUME:-false}"
+# Set to a file path to export incrementally. Each run only exports and
+# enriches workflows not recorded in the file and adds them as new
+# workflow.NNN.csv / result files. Cannot be combined with EXPORT_PAGE_SIZE
+# or EXPORT_PARALLEL.
+EXPORT_STATE_FILE="${EXPORT_STATE_FILE:-}"
+# With EXPORT_STATE_FILE, workflows requested this many days before the newest
+# exported one are scanned again, so requests approved or executed after the
+# previous run are still added.
+EXPORT_STATE_LOOKBACK_DAYS="${EXPORT_STATE_LOOKBACK_DAYS:-30}"
+# Number of worker processes, each exporting its own wr.id range on a separate
+# DB connection. Cannot be combined with EXPORT_PAGE_SIZE.
+EXPORT_PARALLEL="${EXPORT_PARALLEL:-1}"
+# 'server' builds approval step columns in the query, 'client' pivots raw
+# approval assignee rows on this host.
+EXPORT_APPROVAL_PIVOT="${EXPORT_APPROVAL_PIVOT:-server}"
+# Number of worker processes enriching row batches, each with its own DB
+# connections. Output rows keep the input order.
+ENRICH_WORKERS="${ENRICH_WORKERS:-1}"
+# Target seconds per Query Audit/blob_meta lookup query. When set, workflow
+# batches grow or shrink between 20 and 5000 UUIDs to stay near it. Empty or 0
+# keeps the fixed default batch size.
+ENRICH_LOOKUP_TARGET_SECONDS="${ENRICH_LOOKUP_TARGET_SECONDS:-}"
+# SQLite file that keeps ledger targets and snapshot sizes between enrichment
+# runs. Empty disables the cache.
+ENRICH_METADATA_CACHE="${ENRICH_METADATA_CACHE:-}"
+# Set to true to only print EXPLAIN findings and suggested indexes for the
+# export queries and the first enrichment batch. No files are written; the
+# enrichment step explains the first existing workflow.NNN.csv file.
+EXPLAIN_QUERIES="${EXPLAIN_QUERIES:-false}"
+# Result file format: csv, csv.gz, jsonl or parquet (requires pyarrow).
+# Intermediate workflow.NNN.csv files stay CSV.
+OUTPUT_FORMAT="${OUTPUT_FORMAT:-csv}"
 
 # App DB connection. QUERYPIE_LOG_DB_* and QUERYPIE_SNAPSHOT_DB_* may override
 # the corresponding values when those databases are hosted separately.
@@ -45,31 +93,129 @@ if [ "$INCLUDE_DML_SNAPSHOTS" = "true" ]; then
   DML_SNAPSHOT_OPTION=(--include-dml-snapshots)
 fi
 
+SKIP_UNAUDITED_OPTION=()
+if [ "$SKIP_UNAUDITED_WORKFLOWS" = "true" ]; then
+  SKIP_UNAUDITED_OPTION=(--skip-unaudited-workflows)
+fi
+
+PAGE_OPTION=()
+if [ "$EXPORT_PAGE_SIZE" -gt 0 ]; then
+  PAGE_OPTION=(--page-size "$EXPORT_PAGE_SIZE")
+  if [ "$EXPORT_RESUME" = "true" ]; then
+    PAGE_OPTION+=(--resume)
+  fi
+fi
+
+LINK_PATTERN_OPTION=()
+for LINK_PATTERN in "${LINK_PATTERNS[@]}"; do
+  LINK_PATTERN_OPTION+=(--link-pattern "$LINK_PATTERN")
+done
+
+STATE_OPTION=()
+if [ -n "$EXPORT_STATE_FILE" ]; then
+  STATE_OPTION=(--state-file "$EXPORT_STATE_FILE" --state-lookback-days "$EXPORT_STATE_LOOKBACK_DAYS")
+fi
+
+METADATA_CACHE_OPTION=()
+if [ -n "$ENRICH_METADATA_CACHE" ]; then
+  METADATA_CACHE_OPTION=(--metadata-cache "$ENRICH_METADATA_CACHE")
+fi
+
+LOOKUP_OPTION=()
+if [ -n "$ENRICH_LOOKUP_TARGET_SECONDS" ]; then
+  LOOKUP_OPTION=(--lookup-target-seconds "$ENRICH_LOOKUP_TARGET_SECONDS")
+fi
+
+EXPLAIN_OPTION=()
+if [ "$EXPLAIN_QUERIES" = "true" ]; then
+  EXPLAIN_OPTION=(--explain)
+fi
+
+case "$OUTPUT_FORMAT" in
+  csv) OUTPUT_EXT=".csv" ;;
+  csv.gz) OUTPUT_EXT=".csv.gz" ;;
+  jsonl) OUTPUT_EXT=".jsonl" ;;
+  parquet) OUTPUT_EXT=".parquet" ;;
+  *)
+    echo "OUTPUT_FORMAT must be csv, csv.gz, jsonl or parquet." >&2
+    exit 1
+    ;;
+esac
+
 VENDOR_OPTION=()
 if [ -d "$VENDOR_DIR" ]; then
   VENDOR_OPTION=(--vendor-dir "$VENDOR_DIR")
 fi
 
+if [ "$STREAMING_PIPELINE" = "true" ]; then
+  python2.7 export_enrich_workflow_sql_audit.py \
+    "${VENDOR_OPTION[@]}" \
+    --output $BASEDIR/workflow.csv \
+    --rows-per-file 70 \
+    --from-kst "$FROM" \
+    --to-kst "$TO" \
+    "${STATE_OPTION[@]}" \
+    "${LINK_PATTERN_OPTION[@]}" \
+    --approval-pivot "$EXPORT_APPROVAL_PIVOT" \
+    --log-db-host "$LOG_DB_HOST" \
+    --log-db-port "$LOG_DB_PORT" \
+    --log-db-user "$LOG_DB_USER" \
+    --log-db-password "$LOG_DB_PASSWORD" \
+    --log-db-name "$LOG_DB_NAME" \
+    --app-db-host "$DB_HOST" \
+    --app-db-port "$DB_PORT" \
+    --app-db-user "$DB_USER" \
+    --app-db-password "$QUERYPIE_DB_PASSWORD" \
+    --app-db-name "$DB_NAME" \
+    --snapshot-db-host "$SNAPSHOT_DB_HOST" \
+    --snapshot-db-port "$SNAPSHOT_DB_PORT" \
+    --snapshot-db-user "$SNAPSHOT_DB_USER" \
+    --snapshot-db-password "$SNAPSHOT_DB_PASSWORD" \
+    --snapshot-db-name "$SNAPSHOT_DB_NAME" \
+    "${APPROVAL_RULE_OPTION[@]}" \
+    "${DML_SNAPSHOT_OPTION[@]}" \
+    "${SKIP_UNAUDITED_OPTION[@]}" \
+    "${METADATA_CACHE_OPTION[@]}" \
+    "${LOOKUP_OPTION[@]}" \
+    "${EXPLAIN_OPTION[@]}" \
+    --format "$OUTPUT_FORMAT" \
+    --workers "$ENRICH_WORKERS" \
+    --inline-threshold-bytes 2000 \
+    --large-file-mode skip 2>&1 | tee $BASEDIR/progress/progress_pipeline
+  exit "${PIPESTATUS[0]}"
+fi
+
 python2.7 export_workflow_sql_requests.py \
   --output $BASEDIR/workflow.csv \
   --rows-per-file 70 \
   --from-kst "$FROM" \
   --to-kst "$TO" \
+  --approval-pivot "$EXPORT_APPROVAL_PIVOT" \
+  --parallel "$EXPORT_PARALLEL" \
   "${VENDOR_OPTION[@]}" \
   --db-host "$DB_HOST" \
   --db-port "$DB_PORT" \
   --db-user "$DB_USER" \
   --db-password "$QUERYPIE_DB_PASSWORD" \
   --db-name "$DB_NAME" \
-  "${APPROVAL_RULE_OPTION[@]}" 2>&1 | tee $BASEDIR/progress_export
+  "${APPROVAL_RULE_OPTION[@]}" \
+  "${STATE_OPTION[@]}" \
+  "${LINK_PATTERN_OPTION[@]}" \
+  "${EXPLAIN_OPTION[@]}" \
+  "${PAGE_OPTION[@]}" 2>&1 | tee $BASEDIR/progress_export
 
 for INPUT_PATH in $( /bin/ls $BASEDIR/workflow.*.csv ); do
     INPUT_FILENAME=$( basename $INPUT_PATH)
+    OUTPUT_PATH=$BASEDIR/result/output_${INPUT_FILENAME%.csv}${OUTPUT_EXT}
+    if [ -n "$EXPORT_STATE_FILE" ] && [ -s $OUTPUT_PATH ]; then
+        # Enriched by a previous incremental run.
+        continue
+    fi
     echo " == Process $INPUT_FILENAME =="
     python2.7 enrich_workflow_sql_audit.py \
         "${VENDOR_OPTION[@]}" \
         --input $BASEDIR/${INPUT_FILENAME} \
-        --output $BASEDIR/result/output_${INPUT_FILENAME} \
+        --output $OUTPUT_PATH \
         --workflow-column workflow_uuid \
         --log-db-host "$LOG_DB_HOST" \
         --log-db-port "$LOG_DB_PORT" \
@@ -87,6 +233,16 @@ for INPUT_PATH in $( /bin/ls $BASEDIR/workflow.*.csv ); do
         --snapshot-db-password "$SNAPSHOT_DB_PASSWORD" \
         --snapshot-db-name "$SNAPSHOT_DB_NAME" \
         "${DML_SNAPSHOT_OPTION[@]}" \
+        "${SKIP_UNAUDITED_OPTION[@]}" \
+        "${METADATA_CACHE_OPTION[@]}" \
+        "${LOOKUP_OPTION[@]}" \
+        "${EXPLAIN_OPTION[@]}" \
+        --format "$OUTPUT_FORMAT" \
+        --workers "$ENRICH_WORKERS" \
         --inline-threshold-bytes 2000 \
         --large-file-mode skip 2>&1 | tee $BASEDIR/progress/progress_${INPUT_FILENAME}
+    if [ "$EXPLAIN_QUERIES" = "true" ]; then
+        # The first batch of one file is enough to see the query plans.
+        break
+    fi
 done
@@ -10,17 +10,37 @@ from __future__ import print_function
 
 import argparse
 import csv
+import json
+import multiprocessing
 import os
 import re
+import shutil
 import sys
 from datetime import datetime, timedelta
 
+from audit_db import ConnectionManager
+from audit_explain import explain_plan, print_explain_report
+from audit_output import (
+    FORMAT_EXTENSIONS,
+    OUTPUT_FORMATS,
+    CsvRowWriter,
+    check_output_format,
+    format_output_path,
+    open_row_writer,
+    rows_per_second,
+)
+
 
 PY2 = sys.version_info[0] == 2
 KST_OFFSET = timedelta(hours=9)
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 URL_PATTERN = re.compile(r"https?://[^\s,;\"'<>]+")
 ISSUE_KEY_PATTERN = re.compile(r"\b[A-Za-z]{3,}-\d+\b")
+# Both built-in patterns start with a letter, which skips most positions cheaply.
+LINK_PATTERN = re.compile(u"(?=[A-Za-z])(?:(%s)|(%s))" % (URL_PATTERN.pattern, ISSUE_KEY_PATTERN.pattern))
+APPROVAL_STEP_COLUMN_START = 12
+SERVER_APPROVAL_STEPS = 4
+STATE_LOOKBACK_DAYS = 30
 
 
 class DbConfig(object):
@@ -49,15 +69,6 @@ def to_text(value, encoding="utf-8"):
     return unicode(value) if PY2 else str(value)  # noqa: F821  pylint: disable=undefined-variable
 
 
-def csv_cell_encoding(encoding):
-    return "utf-8" if encoding.lower().replace("_", "-") == "utf-8-sig" else encoding
-
-
-def to_csv_cell(value, encoding):
-    text = to_text(value)
-    return text.encode(csv_cell_encoding(encoding)) if PY2 else text
-
-
 def env_or_default(name, default=None):
     value = os.environ.get(name)
     return value if value not in (None, "") else default
@@ -124,13 +135,70 @@ def parse_args():
         help="Requested-at end time in KST. Exclusive. Default: 2026-08-01 00:00:00.",
     )
     parser.add_argument("--encoding", default="utf-8-sig", help="Output CSV encoding. Default: utf-8-sig.")
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Output file format. csv.gz is gzip compressed CSV, jsonl writes one JSON object per row and parquet requires pyarrow. Default: csv.",
+    )
     parser.add_argument("--fetch-size", type=int, default=1000, help="Rows to fetch per DB round-trip. Default: 1000.")
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=0,
+        help="Export in keyset pages of this many workflows (wr.id > last_id) and keep a checkpoint file next to the output. Use 0 for a single streaming query. Default: 0.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="With --page-size, continue after the last fully written output file recorded in the checkpoint file.",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=None,
+        help="Incremental export state. When the file exists, only workflows not recorded in it are exported, scanning from --state-lookback-days before its newest requested_at, and split file numbering continues after its last file. The file is updated after each successful export.",
+    )
+    parser.add_argument(
+        "--state-lookback-days",
+        type=int,
+        default=STATE_LOOKBACK_DAYS,
+        help="With --state-file, scan again the workflows requested this many days before the newest exported one, so workflows approved or executed after the previous run are still exported. Default: %s." % STATE_LOOKBACK_DAYS,
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Split the window into this many wr.id ranges, export each on its own connection in a worker process and merge the results in wr.id order. Default: 1.",
+    )
+    parser.add_argument(
+        "--approval-pivot",
+        choices=("server", "client"),
+        default="server",
+        help="'server' builds approval step columns with GROUP_CONCAT in the query. 'client' streams raw approval assignee rows on a second connection and pivots them in Python. Default: server.",
+    )
+    parser.add_argument(
+        "--approval-steps",
+        type=int,
+        default=SERVER_APPROVAL_STEPS,
+        help="Number of approval step columns with --approval-pivot client. Default: 4.",
+    )
     parser.add_argument(
         "--approval-rule-name",
         action="append",
         default=[],
         help="Filter by approval rule name. Accepts comma-separated names and can be specified multiple times. Default: all approval rule names.",
     )
+    parser.add_argument(
+        "--link-pattern",
+        action="append",
+        default=[],
+        help="Extra regular expression reported in the change request link column, e.g. a ServiceNow ticket number or an internal tool URL. Each pattern is compiled on its own, so inline flags such as (?i) and backreferences apply to that pattern only. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Print EXPLAIN FORMAT=JSON findings (full scans, filesorts) and suggested indexes for the queries of the first page or range, then exit without exporting.",
+    )
     parser.add_argument(
         "--vendor-dir",
         default=env_or_default("QUERYPIE_AUDIT_VENDOR_DIR"),
@@ -145,6 +213,24 @@ def parse_args():
     args = parser.parse_args()
     if args.rows_per_file < 0:
         raise SystemExit("--rows-per-file must be 0 or greater.")
+    if args.page_size < 0:
+        raise SystemExit("--page-size must be 0 or greater.")
+    if args.resume and args.page_size == 0:
+        raise SystemExit("--resume requires --page-size.")
+    if args.parallel <= 0:
+        raise SystemExit("--parallel must be greater than 0.")
+    if args.parallel > 1 and args.page_size > 0:
+        raise SystemExit("--parallel cannot be combined with --page-size.")
+    if args.state_file and (args.parallel > 1 or args.page_size > 0):
+        raise SystemExit("--state-file cannot be combined with --parallel or --page-size.")
+    if args.state_lookback_days < 0:
+        raise SystemExit("--state-lookback-days must be 0 or greater.")
+    if args.approval_steps <= 0:
+        raise SystemExit("--approval-steps must be greater than 0.")
+    if args.approval_pivot == "server" and args.approval_steps != SERVER_APPROVAL_STEPS:
+        raise SystemExit("--approval-steps other than %s requires --approval-pivot client." % SERVER_APPROVAL_STEPS)
+    check_output_format(args.format)
+    build_link_extractor(args.link_pattern)
     args.approval_rule_name = split_approval_rule_names(args.approval_rule_name)
     return args
 
@@ -180,60 +266,175 @@ def connect(config, streaming=False):
         )
 
 
-def open_csv_writer(path, encoding):
-    parent = os.path.dirname(os.path.abspath(path))
-    if parent and not os.path.exists(parent):
-        os.makedirs(parent)
+def search_non_empty(pattern, text, position):
+    # An empty match records nothing, so look past it like findall() does.
+    match = pattern.search(text, position)
+    while match is not None and match.end() == match.start():
+        if match.start() >= len(text):
+            return None
+        match = pattern.search(text, match.start() + 1)
+    return match
 
-    if PY2:
-        fp = open(path, "wb")
-        if encoding.lower().replace("_", "-") == "utf-8-sig":
-            fp.write(u"\ufeff".encode("utf-8"))
-        return fp, csv.writer(fp, quoting=csv.QUOTE_ALL)
 
-    fp = open(path, "w", newline="", encoding=encoding)
-    return fp, csv.writer(fp, quoting=csv.QUOTE_ALL)
+class LinkExtractor(object):
+    """Find extra patterns, URLs and issue keys, in first-seen order without duplicates.
 
+    Each extra pattern is compiled on its own, so inline flags and
+    backreferences keep their meaning. Matches are merged by position the way
+    one alternation would: the leftmost match wins, extra patterns win over
+    the built-in ones at the same position, and scanning resumes after it.
+    Their whole match is reported as is.
+    """
 
-def write_row(writer, row, encoding):
-    writer.writerow([to_csv_cell(cell, encoding) for cell in row])
+    def __init__(self, extra_patterns=()):
+        self.extra_patterns = [re.compile(to_text(pattern)) for pattern in extra_patterns]
 
+    def merged_matches(self, text):
+        """Return (url, issue key, extra match) for each match, two of them empty."""
+        patterns = self.extra_patterns + [LINK_PATTERN]
+        upcoming = [search_non_empty(pattern, text, 0) for pattern in patterns]
+        matches = []
+        position = 0
+        while True:
+            best = None
+            for index, pattern in enumerate(patterns):
+                match = upcoming[index]
+                if match is not None and match.start() < position:
+                    match = upcoming[index] = search_non_empty(pattern, text, position)
+                if match is not None and (best is None or match.start() < best.start()):
+                    best = match
+            if best is None:
+                return matches
+            position = best.end()
+            if best.re is LINK_PATTERN:
+                matches.append((best.group(1) or u"", best.group(2) or u"", u""))
+            else:
+                matches.append((u"", u"", best.group(0)))
+
+    def extract(self, value):
+        links = []
+        seen = set()
+        text = to_text(value)
+        # Without extra patterns findall() yields (url, issue key) pairs, one of them set.
+        matches = self.merged_matches(text) if self.extra_patterns else LINK_PATTERN.findall(text)
+        for groups in matches:
+            if groups[0]:
+                url = groups[0]
+                found = [url.rstrip(u".)]}")]
+                if u"-" in url:
+                    # Keys inside a URL, such as a Jira browse link, are listed as well.
+                    found.extend(key.upper() for key in ISSUE_KEY_PATTERN.findall(url))
+            elif groups[1]:
+                found = [groups[1].upper()]
+            else:
+                found = [groups[2]]
+            for link in found:
+                if link not in seen:
+                    seen.add(link)
+                    links.append(link)
+        return u", ".join(links)
+
+
+DEFAULT_LINK_EXTRACTOR = LinkExtractor()
+
+
+def build_link_extractor(extra_patterns):
+    for pattern in extra_patterns:
+        try:
+            re.compile(to_text(pattern))
+        except re.error as exc:
+            raise SystemExit("Invalid --link-pattern %s: %s" % (pattern, exc))
+    return LinkExtractor(extra_patterns) if extra_patterns else DEFAULT_LINK_EXTRACTOR
 
-def extract_unique_urls(value):
-    urls = []
-    seen = set()
-    for match in URL_PATTERN.findall(to_text(value)):
-        url = match.rstrip(u".)]}")
-        seen.add(url)
-    for match in ISSUE_KEY_PATTERN.findall(to_text(value)):
-        key = to_text(match).upper()
-        seen.add(key)
-    return u", ".join(list(seen))
+
+def extract_unique_urls(value, link_extractor=None):
+    return (link_extractor or DEFAULT_LINK_EXTRACTOR).extract(value)
 
 
-def transform_export_row(row):
+def transform_export_row(row, link_index=20, link_extractor=None):
     values = list(row)
-    if len(values) >= 21:
-        values[20] = extract_unique_urls(values[8])
+    if len(values) > link_index:
+        values[link_index] = extract_unique_urls(values[8], link_extractor)
     return values
 
 
-def split_output_path(output_path, file_index):
+def split_output_path(output_path, file_index, output_format="csv"):
     #if file_index <= 1:
     #    return output_path
+    if output_format != "csv":
+        base = format_output_path(output_path, "csv")[: -len(".csv")]
+        return "%s.%03d%s" % (base, file_index, FORMAT_EXTENSIONS[output_format])
     base, ext = os.path.splitext(output_path)
     if not ext:
         ext = ".csv"
     return "%s.%03d%s" % (base, file_index, ext)
 
 
-def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_per_file, approval_rule_names):
+EXPORT_HEADER = [
+    u"workflow_id",
+    u"승인 상태",
+    u"실행 상태",
+    u"workflow 상신일",
+    u"사후결제여부",
+    u"변경수행일",
+    u"변경요청자",
+    u"변경제목",
+    u"변경사유",
+    u"DB명 (Connection/DB)",
+    u"요청자",
+    u"수행자",
+    u"1차승인자",
+    u"1차승인일시",
+    u"2차승인자",
+    u"2차승인일시",
+    u"3차승인자",
+    u"3차승인일시",
+    u"4차승인자",
+    u"4차승인일시",
+    u"변경요청 근거 (관리툴 링크)",
+    u"workflow_uuid",
+    u"Workflow Ledger 여부",
+    u"결제선 Ledger 여부",
+    u"rule_name",
+]
+
+
+def approval_step_header(steps):
+    header = []
+    for step in range(1, steps + 1):
+        header.extend([u"%s차승인자" % step, u"%s차승인일시" % step])
+    return header
+
+
+def export_header(approval_steps):
+    start = APPROVAL_STEP_COLUMN_START
+    end = start + 2 * SERVER_APPROVAL_STEPS
+    return EXPORT_HEADER[:start] + approval_step_header(approval_steps) + EXPORT_HEADER[end:]
+
+
+def request_filter_sql(approval_rule_names):
+    """WHERE conditions for exported requests. Params: from_utc, to_utc, then rule names."""
     approval_rule_filter = ""
     if approval_rule_names:
-        approval_rule_filter = "          AND rule.name IN (%s)\n" % ",".join(["%s"] * len(approval_rule_names))
-
-    sql = """
-        WITH approval_lines AS (
+        approval_rule_filter = "\n              AND rule.name IN (%s)" % ",".join(["%s"] * len(approval_rule_names))
+    return """wr.requested_at >= %s
+              AND wr.requested_at <  %s
+              AND wr.request_type = 'SQL_EXECUTION'
+              AND wr.approval_status = 'APPROVED'
+              AND wr.execution_status = 'SUCCESS'""" + approval_rule_filter
+
+
+def build_export_sql(approval_rule_names, keyset=False, server_pivot=True):
+    keyset_filter = ""
+    if keyset:
+        keyset_filter = "\n              AND wr.id >  %s\n              AND wr.id <= %s"
+
+    approval_lines = ""
+    approval_columns = ""
+    approval_join = ""
+    if server_pivot:
+        approval_lines = """,
+        approval_lines AS (
             SELECT
                 a.workflow_request_uuid,
 
@@ -349,10 +550,36 @@ def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_
                     SEPARATOR ', '
                 ) AS approval_step_4_at
             FROM querypie.workflow_request_approval_assignees a
+            INNER JOIN filtered_requests fr
+                    ON fr.uuid = a.workflow_request_uuid
             LEFT JOIN querypie.users actor
                    ON actor.uuid = a.action_by_uuid
             GROUP BY a.workflow_request_uuid
-        )
+        )"""
+        approval_columns = """
+            al.approval_step_1 AS `1차승인자`,
+            al.approval_step_1_at AS `1차승인일시`,
+            al.approval_step_2 AS `2차승인자`,
+            al.approval_step_2_at AS `2차승인일시`,
+            al.approval_step_3 AS `3차승인자`,
+            al.approval_step_3_at AS `3차승인일시`,
+            al.approval_step_4 AS `4차승인자`,
+            al.approval_step_4_at AS `4차승인일시`,"""
+        approval_join = """
+        LEFT JOIN approval_lines al
+               ON al.workflow_request_uuid = wr.uuid"""
+
+    # The date window and rule filter are applied once in filtered_requests and
+    # every aggregation below is a semi-join on it, so a short window never
+    # groups the assignee tables for the whole history.
+    sql = """
+        WITH filtered_requests AS (
+            SELECT wr.id, wr.uuid
+            FROM querypie.workflow_requests wr
+            LEFT JOIN querypie.workflow_rules rule
+                   ON rule.uuid = wr.rule_uuid
+            WHERE {request_filter}{keyset_filter}
+        ){approval_lines}
         SELECT
             wr.id AS workflow_id,
             wr.approval_status,
@@ -371,15 +598,7 @@ def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_
             wr.comments AS `변경사유`,
             CONCAT_WS(' / ', NULLIF(cg.name, ''), NULLIF(se.`database`, '')) AS `DB명 (Connection/DB)`,
             wr.requester_login_id AS `요청자`,
-            ex.execution_assignees AS `수행자`,
-            al.approval_step_1 AS `1차승인자`,
-            al.approval_step_1_at AS `1차승인일시`,
-            al.approval_step_2 AS `2차승인자`,
-            al.approval_step_2_at AS `2차승인일시`,
-            al.approval_step_3 AS `3차승인자`,
-            al.approval_step_3_at AS `3차승인일시`,
-            al.approval_step_4 AS `4차승인자`,
-            al.approval_step_4_at AS `4차승인일시`,
+            ex.execution_assignees AS `수행자`,{approval_columns}
             '' AS `변경요청 근거 (관리툴 링크)`,
             wr.uuid AS workflow_uuid,
             CASE WHEN COALESCE(wr.ledger, 0) = 1 THEN 'Y' ELSE 'N' END AS `Workflow Ledger 여부`,
@@ -389,7 +608,9 @@ def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_
                 WHEN rule.name = 'Privacy Rule' THEN 'Privacy'
                 ELSE rule.name
             END AS rule_name
-        FROM querypie.workflow_requests wr
+        FROM filtered_requests fr
+        INNER JOIN querypie.workflow_requests wr
+                ON wr.id = fr.id
         LEFT JOIN querypie.workflow_rules rule
                ON rule.uuid = wr.rule_uuid
         LEFT JOIN querypie.workflow_request_detail_sql_executions se
@@ -397,9 +618,7 @@ def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_
         LEFT JOIN querypie.clusters c
                ON c.uuid = se.object_uuid
         LEFT JOIN querypie.cluster_groups cg
-               ON cg.id = c.group_id
-        LEFT JOIN approval_lines al
-               ON al.workflow_request_uuid = wr.uuid
+               ON cg.id = c.group_id{approval_join}
         LEFT JOIN (
             SELECT
                 e.workflow_request_uuid,
@@ -423,6 +642,8 @@ def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_
                     SEPARATOR ', '
                 ) AS execution_assignees
             FROM querypie.workflow_request_execution_assignees e
+            INNER JOIN filtered_requests fr
+                    ON fr.uuid = e.workflow_request_uuid
             LEFT JOIN querypie.users assignee
                    ON assignee.uuid = e.user_uuid
             LEFT JOIN querypie.users actor
@@ -431,80 +652,767 @@ def export_rows(conn, output_path, from_utc, to_utc, encoding, fetch_size, rows_
             GROUP BY e.workflow_request_uuid
         ) ex
                ON ex.workflow_request_uuid = wr.uuid
-        WHERE wr.requested_at >= %s
-          AND wr.requested_at <  %s
-          AND wr.request_type = 'SQL_EXECUTION'
-          AND wr.approval_status = 'APPROVED'
-          AND wr.execution_status = 'SUCCESS'
-{approval_rule_filter}
         ORDER BY wr.id ASC
-    """.format(approval_rule_filter=approval_rule_filter)
-    header = [
-        u"workflow_id",
-        u"승인 상태",
-        u"실행 상태",
-        u"workflow 상신일",
-        u"사후결제여부",
-        u"변경수행일",
-        u"변경요청자",
-        u"변경제목",
-        u"변경사유",
-        u"DB명 (Connection/DB)",
-        u"요청자",
-        u"수행자",
-        u"1차승인자",
-        u"1차승인일시",
-        u"2차승인자",
-        u"2차승인일시",
-        u"3차승인자",
-        u"3차승인일시",
-        u"4차승인자",
-        u"4차승인일시",
-        u"변경요청 근거 (관리툴 링크)",
-        u"workflow_uuid",
-        u"Workflow Ledger 여부",
-        u"결제선 Ledger 여부",
-        u"rule_name",
-    ]
-
-    cursor = conn.cursor()
-    fp = None
-    writer = None
-    count = 0
-    output_paths = []
+    """.format(
+        request_filter=request_filter_sql(approval_rule_names),
+        keyset_filter=keyset_filter,
+        approval_lines=approval_lines,
+        approval_columns=approval_columns,
+        approval_join=approval_join,
+    )
+    return sql
+
+
+def build_page_bound_sql(approval_rule_names):
+    """Return the last wr.id of the next keyset page, so a page never splits one workflow's rows."""
+    return """
+        SELECT MAX(page.id) AS page_last_id
+        FROM (
+            SELECT wr.id
+            FROM querypie.workflow_requests wr
+            LEFT JOIN querypie.workflow_rules rule
+                   ON rule.uuid = wr.rule_uuid
+            WHERE {request_filter}
+              AND wr.id > %s
+            ORDER BY wr.id ASC
+            LIMIT %s
+        ) page
+    """.format(request_filter=request_filter_sql(approval_rule_names))
+
+
+def build_approval_assignees_sql(approval_rule_names, keyset=False):
+    """Raw approval assignee rows for client-side pivot, in the export's wr.id order."""
+    keyset_filter = ""
+    if keyset:
+        keyset_filter = "\n              AND wr.id >  %s\n              AND wr.id <= %s"
+    return """
+        WITH filtered_requests AS (
+            SELECT wr.id, wr.uuid
+            FROM querypie.workflow_requests wr
+            LEFT JOIN querypie.workflow_rules rule
+                   ON rule.uuid = wr.rule_uuid
+            WHERE {request_filter}{keyset_filter}
+        )
+        SELECT
+            fr.id AS workflow_id,
+            a.`order` AS step_order,
+            a.status,
+            COALESCE(
+                NULLIF(a.actor_login_id, ''),
+                NULLIF(actor.login_id, ''),
+                NULLIF(a.action_by_uuid, ''),
+                NULLIF(a.api_user_uuid, ''),
+                'UNKNOWN'
+            ) AS actor,
+            DATE_FORMAT(DATE_ADD(a.action_at, INTERVAL 9 HOUR), '%%Y-%%m-%%d %%H:%%i:%%s') AS action_at
+        FROM querypie.workflow_request_approval_assignees a
+        INNER JOIN filtered_requests fr
+                ON fr.uuid = a.workflow_request_uuid
+        LEFT JOIN querypie.users actor
+               ON actor.uuid = a.action_by_uuid
+        WHERE a.status IN ('APPROVED', 'REJECTED')
+        ORDER BY fr.id, a.`order`, a.action_at, COALESCE(a.actor_login_id, actor.login_id, a.action_by_uuid)
+    """.format(request_filter=request_filter_sql(approval_rule_names), keyset_filter=keyset_filter)
+
+
+class ApprovalStepPivot(object):
+    """Pivot approval assignee rows, sorted by workflow id, into step columns of export rows."""
+
+    def __init__(self, rows, steps):
+        self.steps = steps
+        self.overflow_workflow_ids = set()
+        self.groups = self.iter_groups(rows)
+        self.pending = next(self.groups, None)
+
+    def iter_groups(self, rows):
+        current_id = None
+        actors = None
+        action_ats = None
+        for workflow_id, step_order, status, actor, action_at in rows:
+            if workflow_id != current_id:
+                if current_id is not None:
+                    yield current_id, self.step_values(actors, action_ats)
+                current_id = workflow_id
+                actors = [[] for _ in range(self.steps)]
+                action_ats = [[] for _ in range(self.steps)]
+            index = int(step_order) if step_order is not None else -1
+            if index < 0 or index >= self.steps:
+                self.overflow_workflow_ids.add(workflow_id)
+                continue
+            actors[index].append((u"REJECT " if to_text(status) == u"REJECTED" else u"") + to_text(actor))
+            if action_at is not None:
+                action_ats[index].append(to_text(action_at))
+        if current_id is not None:
+            yield current_id, self.step_values(actors, action_ats)
+
+    def step_values(self, actors, action_ats):
+        values = []
+        for index in range(self.steps):
+            values.extend([u", ".join(actors[index]), u", ".join(action_ats[index])])
+        return values
+
+    def values_for(self, workflow_id):
+        while self.pending is not None and self.pending[0] < workflow_id:
+            self.pending = next(self.groups, None)
+        if self.pending is not None and self.pending[0] == workflow_id:
+            return self.pending[1]
+        return [u""] * (2 * self.steps)
+
+    def merge(self, row):
+        start = APPROVAL_STEP_COLUMN_START
+        return list(row[:start]) + self.values_for(row[0]) + list(row[start:])
+
+
+def split_checkpoint_path(output_path):
+    base, _ = os.path.splitext(output_path)
+    return "%s.checkpoint.json" % base
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    fp = open(path, "r")
+    try:
+        return json.load(fp)
+    except ValueError:
+        raise SystemExit("Checkpoint file is not valid JSON: %s" % path)
+    finally:
+        fp.close()
 
-    def open_next_file():
-        path = split_output_path(output_path, len(output_paths) + 1)
-        next_fp, next_writer = open_csv_writer(path, encoding)
-        write_row(next_writer, header, encoding)
-        output_paths.append(path)
-        return next_fp, next_writer
 
+def write_checkpoint(path, checkpoint):
+    # Write to a temporary file first so a crash never leaves a half-written checkpoint.
+    temp_path = path + ".tmp"
+    fp = open(temp_path, "w")
     try:
-        try:
-            cursor.execute("SET SESSION group_concat_max_len = 1048576")
-        except Exception:
-            pass
+        json.dump(checkpoint, fp, indent=2, sort_keys=True)
+    finally:
+        fp.close()
+    os.rename(temp_path, path)
+
+
+def new_checkpoint(
+    from_utc,
+    to_utc,
+    rows_per_file,
+    approval_rule_names,
+    approval_steps,
+    approval_pivot="server",
+    output_format="csv",
+    encoding="utf-8-sig",
+    link_patterns=(),
+):
+    return {
+        "from_utc": format_datetime(from_utc),
+        "to_utc": format_datetime(to_utc),
+        "rows_per_file": rows_per_file,
+        "approval_rule_names": list(approval_rule_names),
+        "approval_steps": approval_steps,
+        "approval_pivot": approval_pivot,
+        "format": output_format,
+        "encoding": encoding,
+        "link_patterns": [to_text(pattern) for pattern in link_patterns],
+        "files": [],
+        "completed": False,
+    }
+
+
+# Resuming with any of these changed would mix differently shaped files in one export.
+CHECKPOINT_OPTION_KEYS = (
+    "from_utc",
+    "to_utc",
+    "rows_per_file",
+    "approval_rule_names",
+    "approval_steps",
+    "approval_pivot",
+    "format",
+    "encoding",
+    "link_patterns",
+)
+
+
+def validate_checkpoint(checkpoint, expected, path):
+    for key in CHECKPOINT_OPTION_KEYS:
+        if checkpoint.get(key) != expected[key]:
+            raise SystemExit(
+                "Checkpoint %s was written with a different %s (%s). Remove it or rerun without --resume."
+                % (path, key, checkpoint.get(key)),
+            )
+
+
+def new_export_state(output_path, approval_rule_names, approval_steps):
+    return {
+        "output": output_path,
+        "approval_rule_names": list(approval_rule_names),
+        "approval_steps": approval_steps,
+        "last_id": 0,
+        "last_requested_at_kst": None,
+        "rescan_from_kst": None,
+        "exported_ids": [],
+        "file_count": 0,
+        "rows": 0,
+    }
+
+
+def load_export_state(path, output_path, approval_rule_names, approval_steps):
+    """Return the saved incremental export state, or a new one when path does not exist yet."""
+    state = new_export_state(output_path, approval_rule_names, approval_steps)
+    if not os.path.exists(path):
+        return state
+    fp = open(path, "r")
+    try:
+        saved = json.load(fp)
+    except ValueError:
+        raise SystemExit("State file is not valid JSON: %s" % path)
+    finally:
+        fp.close()
+    for key in ("output", "approval_rule_names", "approval_steps"):
+        if saved.get(key) != state[key]:
+            raise SystemExit(
+                "State file %s was written with a different %s (%s). Remove it to export the whole window again."
+                % (path, key, saved.get(key)),
+            )
+    return saved
+
+
+def export_state_from_utc(state, from_utc):
+    """Start the window at the previous run's look-back. skip_exported_rows() removes the rows already exported."""
+    if not state.get("rescan_from_kst"):
+        return from_utc
+    return max(from_utc, parse_kst_datetime(state["rescan_from_kst"]) - KST_OFFSET)
+
+
+def skip_exported_rows(rows, state):
+    """Drop the rows of workflows an earlier incremental run already exported."""
+    exported_ids = set(workflow_id for workflow_id, _ in state["exported_ids"])
+    for row in rows:
+        if int(row[0]) not in exported_ids:
+            yield row
+
+
+def record_export_state(path, state, exported, row_count, file_count, lookback_days=STATE_LOOKBACK_DAYS):
+    """Save the state after a run. exported holds (workflow id, requested_at KST) of the rows it wrote.
+
+    Workflows requested up to lookback_days before the newest exported one are
+    scanned again by the next run, since they may still be approved or
+    executed; the ids exported in that span are kept to skip them then.
+    """
+    requested_by_id = dict((int(workflow_id), to_text(requested_at)) for workflow_id, requested_at in state["exported_ids"])
+    for workflow_id, requested_at in exported:
+        requested_by_id[int(workflow_id)] = to_text(requested_at)
+    if requested_by_id:
+        state["last_id"] = max(state["last_id"], max(requested_by_id))
+        last_requested_at = max(requested_by_id.values())
+        if not state["last_requested_at_kst"] or last_requested_at > state["last_requested_at_kst"]:
+            state["last_requested_at_kst"] = last_requested_at
+        rescan_from = format_datetime(parse_kst_datetime(state["last_requested_at_kst"]) - timedelta(days=lookback_days))
+        # Never move back: ids before the previous start are no longer recorded.
+        if state["rescan_from_kst"] and state["rescan_from_kst"] > rescan_from:
+            rescan_from = state["rescan_from_kst"]
+        state["rescan_from_kst"] = rescan_from
+        state["exported_ids"] = sorted(
+            [workflow_id, requested_at] for workflow_id, requested_at in requested_by_id.items() if requested_at >= rescan_from
+        )
+    state["rows"] += row_count
+    state["file_count"] += file_count
+    write_checkpoint(path, state)
+
+
+class SplitCsvWriter(object):
+    """Write export rows into workflow.NNN.csv files of at most rows_per_file rows.
+
+    first_file_index continues the numbering of an earlier incremental export.
+    With another output_format the files are workflow.NNN.csv.gz, .jsonl or .parquet.
+    """
+
+    def __init__(
+        self,
+        output_path,
+        header,
+        encoding,
+        rows_per_file,
+        keep_ids_together=False,
+        on_file_closed=None,
+        first_file_index=1,
+        output_format="csv",
+    ):
+        self.output_path = output_path
+        self.header = header
+        self.encoding = encoding
+        self.rows_per_file = rows_per_file
+        self.keep_ids_together = keep_ids_together
+        self.on_file_closed = on_file_closed
+        self.first_file_index = first_file_index
+        self.output_format = output_format
+        self.output_paths = []
+        self.count = 0
+        self.write_seconds = 0.0
+        self.writer = None
+        self.file_rows = 0
+        self.last_id = None
+
+    def open_next_file(self):
+        path = split_output_path(self.output_path, self.first_file_index + len(self.output_paths), self.output_format)
+        self.writer = open_row_writer(path, self.header, self.output_format, self.encoding, quoting=csv.QUOTE_ALL)
+        self.output_paths.append(path)
+        self.file_rows = 0
+
+    def close_file(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.write_seconds += self.writer.write_seconds
+        self.writer = None
+        if self.on_file_closed is not None:
+            self.on_file_closed(self.output_paths[-1], self.last_id, self.file_rows)
+
+    def write(self, row):
+        row_id = row[0] if row else None
+        if self.writer is None:
+            self.open_next_file()
+        elif self.rows_per_file > 0 and self.file_rows >= self.rows_per_file:
+            # A checkpoint resumes after the last id of a closed file, so the rows of
+            # one workflow must not straddle two files in that mode.
+            if not self.keep_ids_together or row_id != self.last_id:
+                self.close_file()
+                self.open_next_file()
+        self.writer.write(row)
+        self.file_rows += 1
+        self.count += 1
+        self.last_id = row_id
+
+    def close(self):
+        # An empty export still writes a header-only file, unless it only adds to earlier files.
+        if self.writer is None and not self.output_paths and self.first_file_index == 1:
+            self.open_next_file()
+        self.close_file()
+
+
+def stream_rows(cursor, sql, params, fetch_size):
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def prepare_session(conn):
+    """Session setup run after every (re)connect of an export connection."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET SESSION group_concat_max_len = 1048576")
+    except Exception:
+        pass
+    finally:
+        cursor.close()
 
-        params = [format_datetime(from_utc), format_datetime(to_utc)] + approval_rule_names
-        cursor.execute(sql, params)
-        fp, writer = open_next_file()
 
-        while True:
-            rows = cursor.fetchmany(fetch_size)
-            if not rows:
-                break
+def iter_export_range(
+    cursor,
+    approval_cursor,
+    approval_rule_names,
+    params,
+    fetch_size,
+    approval_steps,
+    keyset,
+    overflow_workflow_ids,
+    link_extractor=None,
+):
+    """Yield transformed export rows; with keyset, params end with the (last_id, range_last_id] bounds."""
+    sql = build_export_sql(approval_rule_names, keyset=keyset, server_pivot=approval_cursor is None)
+    link_index = APPROVAL_STEP_COLUMN_START + 2 * approval_steps
+    pivot = None
+    if approval_cursor is not None:
+        approval_rows = stream_rows(
+            approval_cursor,
+            build_approval_assignees_sql(approval_rule_names, keyset=keyset),
+            params,
+            fetch_size,
+        )
+        pivot = ApprovalStepPivot(approval_rows, approval_steps)
+    for row in stream_rows(cursor, sql, params, fetch_size):
+        if pivot is not None:
+            row = pivot.merge(row)
+        yield transform_export_row(row, link_index, link_extractor)
+    if pivot is not None:
+        # Drain the unbuffered result so the connection can run the next query.
+        for _ in pivot.groups:
+            pass
+        overflow_workflow_ids.update(pivot.overflow_workflow_ids)
+
+
+def iter_keyset_pages(cursor, approval_rule_names, params, last_id, page_size):
+    bound_sql = build_page_bound_sql(approval_rule_names)
+    while True:
+        cursor.execute(bound_sql, params + [last_id, page_size])
+        bound = cursor.fetchall()
+        page_last_id = bound[0][0] if bound else None
+        if page_last_id is None:
+            break
+        yield params + [last_id, page_last_id], True
+        last_id = page_last_id
+
+
+def export_rows(
+    conn,
+    output_path,
+    from_utc,
+    to_utc,
+    encoding,
+    fetch_size,
+    rows_per_file,
+    approval_rule_names,
+    page_size=0,
+    resume=False,
+    approval_conn=None,
+    approval_steps=SERVER_APPROVAL_STEPS,
+    state_path=None,
+    output_format="csv",
+    link_patterns=(),
+    state_lookback_days=STATE_LOOKBACK_DAYS,
+):
+    """Export rows to split CSV files and return (row count, output paths, approval pivot overflow, rows/sec written).
+
+    With page_size > 0 the window is read in keyset pages (wr.id > last_id) and a
+    checkpoint recording every fully written file is kept next to the output, so
+    a rerun with resume=True only exports the missing tail.
+
+    With approval_conn, approval step columns are pivoted in Python from raw
+    assignee rows streamed on that connection instead of GROUP_CONCAT.
+
+    With state_path, only workflows the previous runs did not export are
+    exported into new split files, and the state file is updated.
+    Returned paths and counts cover this run only.
+    """
+    state = None
+    if state_path:
+        state = load_export_state(state_path, output_path, approval_rule_names, approval_steps)
+        from_utc = export_state_from_utc(state, from_utc)
+    params = [format_datetime(from_utc), format_datetime(to_utc)] + approval_rule_names
+    checkpoint = None
+    checkpoint_path = split_checkpoint_path(output_path)
+    if page_size > 0:
+        checkpoint = new_checkpoint(
+            from_utc,
+            to_utc,
+            rows_per_file,
+            approval_rule_names,
+            approval_steps,
+            approval_pivot="client" if approval_conn is not None else "server",
+            output_format=output_format,
+            encoding=encoding,
+            link_patterns=link_patterns,
+        )
+        if resume:
+            saved = read_checkpoint(checkpoint_path)
+            if saved is not None:
+                validate_checkpoint(saved, checkpoint, checkpoint_path)
+                checkpoint = saved
+
+    def record_file(path, last_id, row_count):
+        checkpoint["files"].append({"path": path, "last_id": last_id, "rows": row_count})
+        write_checkpoint(checkpoint_path, checkpoint)
+
+    split_writer = SplitCsvWriter(
+        output_path,
+        export_header(approval_steps),
+        encoding,
+        rows_per_file,
+        keep_ids_together=checkpoint is not None,
+        on_file_closed=record_file if checkpoint is not None else None,
+        first_file_index=state["file_count"] + 1 if state is not None else 1,
+        output_format=output_format,
+    )
+    previous_paths = []
+    previous_count = 0
+    last_id = 0
+    if checkpoint is not None:
+        previous_paths = [item["path"] for item in checkpoint["files"]]
+        previous_count = sum(int(item["rows"]) for item in checkpoint["files"])
+        if checkpoint["files"] and checkpoint["files"][-1]["last_id"] is not None:
+            last_id = checkpoint["files"][-1]["last_id"]
+        split_writer.output_paths = list(previous_paths)
+        if checkpoint.get("completed"):
+            return previous_count, previous_paths, set(), 0
+
+    overflow_workflow_ids = set()
+    link_extractor = build_link_extractor(link_patterns)
+    exported = []
+    cursor = conn.cursor()
+    approval_cursor = approval_conn.cursor() if approval_conn is not None else None
+    try:
+        if checkpoint is None:
+            ranges = [(params, False)]
+        else:
+            ranges = iter_keyset_pages(cursor, approval_rule_names, params, last_id, page_size)
+        for range_params, keyset in ranges:
+            rows = iter_export_range(
+                cursor,
+                approval_cursor,
+                approval_rule_names,
+                range_params,
+                fetch_size,
+                approval_steps,
+                keyset,
+                overflow_workflow_ids,
+                link_extractor,
+            )
+            if state is not None:
+                rows = skip_exported_rows(rows, state)
             for row in rows:
-                if rows_per_file > 0 and count > 0 and count % rows_per_file == 0:
-                    fp.close()
-                    fp, writer = open_next_file()
-                write_row(writer, transform_export_row(row), encoding)
-                count += 1
+                split_writer.write(row)
+                if state is not None:
+                    exported.append((row[0], row[3]))
+        split_writer.close()
     finally:
         cursor.close()
-        if fp is not None:
+        if approval_cursor is not None:
+            approval_cursor.close()
+        if split_writer.writer is not None:
+            split_writer.writer.close()
+
+    if checkpoint is not None:
+        checkpoint["completed"] = True
+        write_checkpoint(checkpoint_path, checkpoint)
+    if state is not None:
+        record_export_state(state_path, state, exported, split_writer.count, len(split_writer.output_paths), state_lookback_days)
+    write_rate = rows_per_second(split_writer.count, split_writer.write_seconds)
+    return previous_count + split_writer.count, split_writer.output_paths, overflow_workflow_ids, write_rate
+
+
+def build_id_bounds_sql(approval_rule_names):
+    return """
+        SELECT MIN(wr.id) AS min_id, MAX(wr.id) AS max_id
+        FROM querypie.workflow_requests wr
+        LEFT JOIN querypie.workflow_rules rule
+               ON rule.uuid = wr.rule_uuid
+        WHERE {request_filter}
+    """.format(request_filter=request_filter_sql(approval_rule_names))
+
+
+def split_id_ranges(min_id, max_id, count):
+    """Split [min_id, max_id] into at most count (last_id, range_last_id] keyset ranges."""
+    step = max(1, (max_id - min_id + count) // count)
+    ranges = []
+    last_id = min_id - 1
+    while last_id < max_id:
+        range_last_id = min(last_id + step, max_id)
+        ranges.append((last_id, range_last_id))
+        last_id = range_last_id
+    return ranges
+
+
+# The first workflow_requests index serves the requested_at window of a single
+# query, the second the wr.id ordered keyset pages and ranges. Both contain
+# every workflow_requests column the filter and the rule join read, so
+# filtered_requests and the page bounds are answered from the index alone.
+EXPORT_INDEX_SUGGESTIONS = (
+    "CREATE INDEX ix_wr_audit_export_window ON querypie.workflow_requests"
+    " (request_type, approval_status, execution_status, requested_at, id, uuid, rule_uuid)",
+    "CREATE INDEX ix_wr_audit_export_keyset ON querypie.workflow_requests"
+    " (request_type, approval_status, execution_status, id, requested_at, uuid, rule_uuid)",
+    "CREATE INDEX ix_wraa_audit_export ON querypie.workflow_request_approval_assignees"
+    " (workflow_request_uuid, status, `order`, action_at)",
+    "CREATE INDEX ix_wrea_audit_export ON querypie.workflow_request_execution_assignees"
+    " (workflow_request_uuid, status, action_at)",
+    "CREATE INDEX ix_wrdse_audit_export ON querypie.workflow_request_detail_sql_executions"
+    " (workflow_request_uuid, object_uuid, `database`)",
+)
+
+
+def explain_export_queries(cursor, approval_rule_names, params, page_size=0, parallel=1, last_id=None, client_pivot=False):
+    """Print EXPLAIN reports for the queries of the first page or range. Returns the number of findings.
+
+    page_size > 0 explains keyset pages starting after last_id (default 0).
+    Otherwise parallel > 1 explains the id bounds query and the first wr.id
+    range, and the default is one query over the whole window.
+    """
+    queries = []
+    range_params, keyset = params, False
+    if page_size > 0:
+        start_id = last_id or 0
+        queries.append(("page bound", build_page_bound_sql(approval_rule_names), params + [start_id, page_size]))
+        range_params, keyset = next(
+            iter_keyset_pages(cursor, approval_rule_names, params, start_id, page_size),
+            (params + [start_id, start_id], True),
+        )
+    elif parallel > 1:
+        bounds_sql = build_id_bounds_sql(approval_rule_names)
+        queries.append(("id bounds", bounds_sql, params))
+        cursor.execute(bounds_sql, params)
+        min_id, max_id = cursor.fetchall()[0][:2]
+        first_range = (0, 0)
+        if max_id is not None:
+            first_range = split_id_ranges(int(min_id), int(max_id), parallel)[0]
+        range_params, keyset = params + list(first_range), True
+    queries.append(("export", build_export_sql(approval_rule_names, keyset=keyset, server_pivot=not client_pivot), range_params))
+    if client_pivot:
+        queries.append(("approval assignees", build_approval_assignees_sql(approval_rule_names, keyset=keyset), range_params))
+    findings = 0
+    for label, sql, query_params in queries:
+        findings += print_explain_report(label, explain_plan(cursor, sql, query_params), EXPORT_INDEX_SUGGESTIONS)
+    return findings
+
+
+def export_part(task):
+    """Worker entry point: export one wr.id range into a headerless UTF-8 part file."""
+    db_config, part_path, params, approval_rule_names, fetch_size, client_pivot, approval_steps, link_patterns = task
+    connections = ConnectionManager(connect)
+    overflow_workflow_ids = set()
+    count = 0
+    writer = None
+    cursor = None
+    approval_cursor = None
+    try:
+        cursor = connections.get(db_config, on_connect=prepare_session, streaming=True).cursor()
+        if client_pivot:
+            approval_cursor = connections.get(db_config, purpose="approval", streaming=True).cursor()
+        writer = CsvRowWriter(part_path, None, "utf-8", quoting=csv.QUOTE_ALL)
+        for row in iter_export_range(
+            cursor,
+            approval_cursor,
+            approval_rule_names,
+            params,
+            fetch_size,
+            approval_steps,
+            True,
+            overflow_workflow_ids,
+            build_link_extractor(link_patterns),
+        ):
+            writer.write(row)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.close()
+        if cursor is not None:
+            cursor.close()
+        if approval_cursor is not None:
+            approval_cursor.close()
+        connections.close_all()
+    return count, sorted(overflow_workflow_ids)
+
+
+def read_part_rows(path):
+    if PY2:
+        fp = open(path, "rb")
+        try:
+            for row in csv.reader(fp):
+                yield row
+        finally:
             fp.close()
-    return count, output_paths
+    else:
+        with open(path, "r", newline="", encoding="utf-8") as fp:
+            for row in csv.reader(fp):
+                yield row
+
+
+def export_rows_parallel(
+    db_config,
+    output_path,
+    from_utc,
+    to_utc,
+    encoding,
+    fetch_size,
+    rows_per_file,
+    approval_rule_names,
+    parallel,
+    client_pivot=False,
+    approval_steps=SERVER_APPROVAL_STEPS,
+    output_format="csv",
+    link_patterns=(),
+):
+    """Export wr.id ranges in a process pool and merge them into the usual split files.
+
+    The ranges are disjoint and ascending, and each part is ordered by wr.id, so
+    concatenating the parts in range order keeps the global wr.id ordering.
+    """
+    params = [format_datetime(from_utc), format_datetime(to_utc)] + approval_rule_names
+    connections = ConnectionManager(connect)
+    try:
+        cursor = connections.get(db_config).cursor()
+        try:
+            cursor.execute(build_id_bounds_sql(approval_rule_names), params)
+            min_id, max_id = cursor.fetchall()[0]
+        finally:
+            cursor.close()
+    finally:
+        connections.close_all()
+
+    base, _ = os.path.splitext(output_path)
+    parts_dir = "%s.parts" % base
+    tasks = []
+    if min_id is not None:
+        for index, (last_id, range_last_id) in enumerate(split_id_ranges(int(min_id), int(max_id), parallel), 1):
+            part_path = os.path.join(parts_dir, "part.%03d.csv" % index)
+            tasks.append(
+                (
+                    db_config,
+                    part_path,
+                    params + [last_id, range_last_id],
+                    approval_rule_names,
+                    fetch_size,
+                    client_pivot,
+                    approval_steps,
+                    list(link_patterns),
+                ),
+            )
+
+    overflow_workflow_ids = set()
+    split_writer = SplitCsvWriter(
+        output_path,
+        export_header(approval_steps),
+        encoding,
+        rows_per_file,
+        output_format=output_format,
+    )
+    try:
+        results = []
+        if tasks:
+            pool = multiprocessing.Pool(processes=min(parallel, len(tasks)))
+            try:
+                results = pool.map(export_part, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        for (_, part_path, _, _, _, _, _, _), (_, part_overflow) in zip(tasks, results):
+            overflow_workflow_ids.update(part_overflow)
+            for row in read_part_rows(part_path):
+                split_writer.write(row)
+        split_writer.close()
+    finally:
+        if split_writer.writer is not None:
+            split_writer.writer.close()
+        if os.path.isdir(parts_dir):
+            shutil.rmtree(parts_dir)
+    write_rate = rows_per_second(split_writer.count, split_writer.write_seconds)
+    return split_writer.count, split_writer.output_paths, overflow_workflow_ids, write_rate
+
+
+def explain_export(args, db_config, from_utc, to_utc):
+    if args.state_file:
+        state = load_export_state(args.state_file, args.output, args.approval_rule_name, args.approval_steps)
+        from_utc = export_state_from_utc(state, from_utc)
+    params = [format_datetime(from_utc), format_datetime(to_utc)] + args.approval_rule_name
+    connections = ConnectionManager(connect)
+    try:
+        cursor = connections.get(db_config, on_connect=prepare_session).cursor()
+        try:
+            findings = explain_export_queries(
+                cursor,
+                args.approval_rule_name,
+                params,
+                page_size=args.page_size,
+                parallel=args.parallel,
+                client_pivot=args.approval_pivot == "client",
+            )
+        finally:
+            cursor.close()
+    finally:
+        connections.close_all()
+    print("explain findings: %s" % findings)
+    return 0
 
 
 def main():
@@ -526,10 +1434,11 @@ def main():
         password=args.db_password,
         database=args.db_name,
     )
-    conn = connect(db_config, streaming=True)
-    try:
-        count, output_paths = export_rows(
-            conn,
+    if args.explain:
+        return explain_export(args, db_config, from_utc, to_utc)
+    if args.parallel > 1:
+        count, output_paths, overflow_workflow_ids, write_rate = export_rows_parallel(
+            db_config,
             args.output,
             from_utc,
             to_utc,
@@ -537,17 +1446,58 @@ def main():
             args.fetch_size,
             args.rows_per_file,
             args.approval_rule_name,
+            args.parallel,
+            client_pivot=args.approval_pivot == "client",
+            approval_steps=args.approval_steps,
+            output_format=args.format,
+            link_patterns=args.link_pattern,
         )
-    finally:
-        conn.close()
+    else:
+        connections = ConnectionManager(connect)
+        try:
+            conn = connections.get(db_config, on_connect=prepare_session, streaming=True)
+            approval_conn = None
+            if args.approval_pivot == "client":
+                approval_conn = connections.get(db_config, purpose="approval", streaming=True)
+            count, output_paths, overflow_workflow_ids, write_rate = export_rows(
+                conn,
+                args.output,
+                from_utc,
+                to_utc,
+                args.encoding,
+                args.fetch_size,
+                args.rows_per_file,
+                args.approval_rule_name,
+                page_size=args.page_size,
+                resume=args.resume,
+                approval_conn=approval_conn,
+                approval_steps=args.approval_steps,
+                state_path=args.state_file,
+                output_format=args.format,
+                link_patterns=args.link_pattern,
+                state_lookback_days=args.state_lookback_days,
+            )
+        finally:
+            connections.close_all()
 
     print("from_kst: %s" % format_datetime(from_kst))
     print("to_kst: %s" % format_datetime(to_kst))
     print("from_utc: %s" % format_datetime(from_utc))
     print("to_utc: %s" % format_datetime(to_utc))
     print("exported rows: %s" % count)
+    print("write rate: %s rows/sec" % write_rate)
     if args.approval_rule_name:
         print("approval_rule_names: %s" % ", ".join(args.approval_rule_name))
+    if args.page_size > 0:
+        print("checkpoint: %s" % split_checkpoint_path(args.output))
+    if args.state_file:
+        print("state: %s" % args.state_file)
+    if overflow_workflow_ids:
+        print(
+            "WARNING: %s workflows have approval steps beyond --approval-steps %s and were truncated."
+            % (len(overflow_workflow_ids), args.approval_steps),
+            file=sys.stderr,
+        )
     print("output files: %s" % len(output_paths))
     for output_path in output_paths:
         print("output: %s" % output_path)
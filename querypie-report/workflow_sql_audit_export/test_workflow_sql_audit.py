@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the workflow SQL audit export scripts. Python 2.7 compatible; run
+from this directory with python -m unittest test_workflow_sql_audit.
+"""
+from __future__ import print_function
+
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import enrich_workflow_sql_audit as enrich
+import export_workflow_sql_requests as exporter
+
+
+def gzip_bytes(data):
+    buffer = io.BytesIO()
+    gzip_file = gzip.GzipFile(fileobj=buffer, mode="wb")
+    gzip_file.write(data)
+    gzip_file.close()
+    return buffer.getvalue()
+
+
+class DecodeQueryTextTest(unittest.TestCase):
+    def test_concatenated_members(self):
+        raw = gzip_bytes(b"select 1;") + gzip_bytes(b" select 2;")
+        self.assertEqual(enrich.decode_query_text(raw, u"short"), u"select 1; select 2;")
+
+    def test_trailing_nul_padding(self):
+        self.assertEqual(enrich.decode_query_text(gzip_bytes(b"abc") + b"\x00\x00", u"short"), u"abc")
+        padding = b"\x00" * (enrich.GZIP_INPUT_CHUNK_BYTES + 10)
+        raw = gzip_bytes(b"abc") + padding + gzip_bytes(b"def") + padding
+        self.assertEqual(enrich.decode_query_text(raw, u"short"), u"abcdef")
+
+    def test_cap_truncates(self):
+        text = enrich.decode_query_text(gzip_bytes(b"x" * 100), u"short", max_bytes=10)
+        self.assertTrue(text.startswith(u"x" * 10 + u"\n"))
+
+    def test_large_input_is_linear(self):
+        # Hex digests compress poorly, so raw stays in the tens of megabytes.
+        data = b"".join(hashlib.sha256(str(index).encode("ascii")).hexdigest().encode("ascii") for index in range(512 * 1024))
+        raw = gzip_bytes(data)
+        started = time.time()
+        text = enrich.decode_query_text(raw, u"short", max_bytes=0)
+        self.assertEqual(len(text), len(data))
+        self.assertLess(time.time() - started, 10)
+
+
+def snapshot(content):
+    return enrich.SnapshotValue(u"uuid", content=content)
+
+
+class SnapshotChangedColumnsTest(unittest.TestCase):
+    def test_reordered_rows_by_key(self):
+        before = snapshot(u"id,name,age\n1,kim,30\n2,lee,40\n3,park,50\n4,choi,60\n")
+        after = snapshot(u"id,name,age\n3,park,51\n1,kim,31\n4,choi,60\n2,lee,41\n")
+        self.assertEqual(enrich.snapshot_changed_columns(before, after), [u"age(3)"])
+
+    def test_reordered_rows_without_key(self):
+        before = snapshot(u"name,age,city\nkim,30,seoul\nlee,40,busan\npark,50,incheon\n")
+        after = snapshot(u"name,age,city\npark,50,incheon\nkim,30,daegu\nlee,40,busan\n")
+        self.assertEqual(enrich.snapshot_changed_columns(before, after), [u"city(1)"])
+
+    def test_document_snapshot_reports_json_paths(self):
+        before = snapshot(u'document\n"{""a"": {""b"": 1, ""c"": [1, 2]}}"\n')
+        after = snapshot(u'document\n"{""a"": {""b"": 2, ""c"": [1, 3]}}"\n')
+        self.assertEqual(enrich.snapshot_changed_columns(before, after), [u"a.b", u"a.c[1]"])
+
+
+def enrich_args(*argv):
+    saved_argv = sys.argv
+    sys.argv = ["enrich_workflow_sql_audit.py", "--input", "in.csv", "--output", "out.csv", "--workflow-column", "1"] + list(argv)
+    try:
+        return enrich.parse_args()
+    finally:
+        sys.argv = saved_argv
+
+
+def failing_connect(config):
+    raise SystemExit("Install PyMySQL or mysql-connector-python to use this script.")
+
+
+class EnrichmentWorkerTest(unittest.TestCase):
+    def run_first_batch(self, args):
+        pool = enrich.open_enrichment_pool(args, 1)
+        try:
+            result = pool.apply_async(enrich.enrich_batch_in_worker, ((None, [], 0, None),))
+            result.wait(60)
+            self.assertTrue(result.ready(), "worker start failure was not reported")
+            return enrich.worker_result(result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_worker_start_error_reaches_parent(self):
+        args = enrich_args()
+        args.app_db_port = "not a port"
+        self.assertRaises(ValueError, self.run_first_batch, args)
+
+    def test_worker_start_system_exit_reaches_parent(self):
+        saved_connect = enrich.connect
+        # Workers are forked, so they see the replaced connect().
+        enrich.connect = failing_connect
+        try:
+            self.assertRaises(SystemExit, self.run_first_batch, enrich_args())
+        finally:
+            enrich.connect = saved_connect
+
+
+def export_row(workflow_id, day):
+    return [workflow_id, u"APPROVED", u"SUCCESS", u"2025-01-%02d 10:00:00" % day]
+
+
+class ExportStateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_export(self, rows, lookback_days=exporter.STATE_LOOKBACK_DAYS):
+        state = exporter.load_export_state(self.path, u"workflow.csv", [], exporter.SERVER_APPROVAL_STEPS)
+        from_utc = exporter.export_state_from_utc(state, exporter.parse_kst_datetime(u"2025-01-01") - exporter.KST_OFFSET)
+        visible = [row for row in rows if exporter.parse_kst_datetime(row[3]) - exporter.KST_OFFSET >= from_utc]
+        exported = list(exporter.skip_exported_rows(visible, state))
+        exporter.record_export_state(self.path, state, [(row[0], row[3]) for row in exported], len(exported), 1, lookback_days)
+        return [row[0] for row in exported]
+
+    def test_workflow_finished_after_previous_run_is_exported(self):
+        # Workflow 2 was still waiting for approval during the first run.
+        self.assertEqual(self.run_export([export_row(1, 1), export_row(3, 3)]), [1, 3])
+        self.assertEqual(self.run_export([export_row(1, 1), export_row(2, 2), export_row(3, 3), export_row(4, 4)]), [2, 4])
+        self.assertEqual(self.run_export([export_row(1, 1), export_row(2, 2), export_row(3, 3), export_row(4, 4)]), [])
+
+    def test_lookback_limits_recorded_ids(self):
+        self.run_export([export_row(1, 1), export_row(9, 9), export_row(10, 10)], lookback_days=1)
+        state = exporter.load_export_state(self.path, u"workflow.csv", [], exporter.SERVER_APPROVAL_STEPS)
+        self.assertEqual(state["rescan_from_kst"], u"2025-01-09 10:00:00")
+        self.assertEqual([workflow_id for workflow_id, _ in state["exported_ids"]], [9, 10])
+        self.assertEqual(state["last_id"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()